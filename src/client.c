@@ -250,6 +250,7 @@ struct mproxy_request {
 #define MPROXY_VERSION 1
 #define MPROXY_REQUEST 0
 #define MPROXY_RESPONSE 1
+#define MPROXY_ERROR 2
 
 /**
  * netlink family
@@ -531,6 +532,13 @@ void *recv_responses_thread(void *arg)
 			/* TODO: could verify that the request is a reply to
 			 * a message we sent. */
 
+			if (req.op == MPROXY_ERROR) {
+				/* error code is carried in the reserved field */
+				pr_err(dc, "detour refused request (error %d)\n",
+				       (req._reserved[0] << 8) | req._reserved[1]);
+				continue; /* next mgr */
+			}
+
 			pr_debug(dc, "received response, sending to kernel\n");
 			detour_add_or_del(dc->sk, &mgr->addr.sin_addr, req.dpt,
 			                  (struct in_addr*)&req.rip, req.rpt,
@@ -23,6 +23,7 @@ containing only headers is created for future inspection.
 from __future__ import print_function
 
 import argparse
+import json
 import os
 import re
 import subprocess
@@ -172,9 +173,9 @@ def is_custom_kernel():
     return 'mptcp' in output and 'detour' in output
 
 
-def setup_nat(net):
+def setup_nat(net, options=''):
     client, detour, server = net.get('client', 'detour', 'server')
-    detour.cmd('./nat_detour.py &')
+    detour.cmd('./nat_detour.py %s &' % options)
     if is_custom_kernel():
         client.cmd('./client daemon ../etc/daemon-nat-vm.conf')
         client.cmd('sysctl -w net.ipv4.tcp_congestion_control=lia')
@@ -186,6 +187,14 @@ def setup_nat(net):
         return 'iperf3 -c ' + detour.IP() + ' -J'
 
 
+def setup_nat_nft(net):
+    return setup_nat(net, '--backend nft')
+
+
+def setup_nat_offload(net):
+    return setup_nat(net, '--backend nft --offload')
+
+
 def setup_vpn(net):
     client, detour, server = net.get('client', 'detour', 'server')
     detour.cmd('./vpn_detour.sh &')
@@ -223,6 +232,8 @@ def setup_ctrl(net):
 
 SETUP = {
     'nat': setup_nat,
+    'nat_nft': setup_nat_nft,
+    'nat_offload': setup_nat_offload,
     'vpn': setup_vpn,
     'control': setup_ctrl,
 }
@@ -268,6 +279,18 @@ def params_delayed():
     params_delay_ms(100)()
 
 
+def params_fast():
+    """
+    This scenario is like 'easy', but no link is rate limited, so throughput
+    is bound by the CPU spent forwarding rather than by the links. Use it to
+    compare the CPU cost per Mbit of detour setups.
+    """
+    d = dict((link, dict(p)) for link, p in BASIC_PARAMS.items())
+    for p in d.values():
+        p.pop('bw', None)
+    return d
+
+
 def params_sym():
     """
     In this scenario, each link has 10 Mbit bandwidth. As a result, there may
@@ -306,6 +329,7 @@ def params_sym_delay_ms(ms):
 
 PARAMS = {
     'easy': params_easy,
+    'fast': params_fast,
     'lossy05': params_loss_rate(0.5),
     'lossy': params_loss_rate(1),
     'lossy2': params_loss_rate(2),
@@ -324,6 +348,25 @@ PARAMS = {
 }
 
 
+def cpu_seconds():
+    """Return the CPU time spent by the whole machine, from /proc/stat."""
+    # Mininet hosts share one kernel, and forwarding happens in softirqs, so
+    # there is no per host figure to read.
+    with open('/proc/stat') as f:
+        fields = [int(x) for x in f.readline().split()[1:]]
+    # Everything but idle and iowait.
+    busy = sum(fields[:8]) - fields[3] - fields[4]
+    return float(busy) / os.sysconf('SC_CLK_TCK')
+
+
+def sent_megabits(output):
+    """Return the Mbit sent by an iperf3 -J client run, or 0."""
+    try:
+        return json.loads(output)['end']['sum_sent']['bytes'] * 8 / 1e6
+    except (ValueError, KeyError, TypeError):
+        return 0.0
+
+
 def scenario(setup_name, params_name, trials=30, trace=False):
     params = PARAMS[params_name]()
     mn = DetourNet(params)
@@ -348,16 +391,29 @@ def scenario(setup_name, params_name, trials=30, trace=False):
     # sleep synchronization is the worst, except for iperf
     time.sleep(0.5)
 
+    # CPU use is only counted while iperf runs, not while we sleep.
+    cpu = 0.0
+    megabits = 0.0
     for _ in range(trials):
         print('.', end='')
         sys.stdout.flush()
+        start = cpu_seconds()
         if iperf_cmd:
-            client.cmd(iperf_cmd)
+            output = client.cmd(iperf_cmd)
         else:
-            client.cmd('iperf3 -c ' + server.IP() + ' -J')
+            output = client.cmd('iperf3 -c ' + server.IP() + ' -J')
+        cpu += cpu_seconds() - start
+        megabits += sent_megabits(output)
         time.sleep(0.5)
 
     print()
+    per_mbit = cpu / megabits if megabits else None
+    with open(fn_base + '.cpu.json', 'w') as f:
+        json.dump({'cpu_seconds': cpu, 'megabits': megabits,
+                   'cpu_seconds_per_mbit': per_mbit}, f)
+    if megabits:
+        print('%.2f CPU seconds for %.0f Mbit: %.3f ms per Mbit' %
+              (cpu, megabits, 1000 * cpu / megabits))
     time.sleep(0.5)
 
     mn.stop()
@@ -25,3 +25,8 @@ PARAMS=delayed
 ./experiment.py -t $TRIALS --params $PARAMS --setup control
 ./experiment.py -t $TRIALS --params $PARAMS --setup nat
 ./experiment.py -t $TRIALS --params $PARAMS --setup vpn
+# Detour CPU use per Mbit, with and without flowtable offload (see
+# doc/MN_EXPERIMENT.md)
+PARAMS=fast
+./experiment.py -t $TRIALS --params $PARAMS --setup nat_nft
+./experiment.py -t $TRIALS --params $PARAMS --setup nat_offload
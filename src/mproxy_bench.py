@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Load generator for the mproxy daemon.
+
+usage: mproxy_bench.py [--daemon IP] [--port PORT] [--clients N] [--rate R]
+           [--duration SECONDS] [--mix NEW,ECHO,CONFLICT]
+
+Simulates many clients, each a UDP socket bound to its own address in
+127.0.0.0/8 (all of which is routed to lo, so no setup is needed), sending a
+mix of requests at a target rate:
+
+- new requests ask for a mapping to a remote port the client has not asked
+  for before, proposing a random dpt,
+- echo requests repeat one of the client's earlier requests, which the daemon
+  should answer from its existing mapping, and
+- conflict requests ask for a new remote port but propose a dpt the client
+  already has a mapping on, so the daemon must pick another.
+
+Throughput, drops and latency percentiles are reported at the end. To measure
+the daemon rather than iptables, run it with the no-op backend:
+
+    python3 nat_detour.py --backend noop
+"""
+
+import argparse
+import random
+import resource
+import selectors
+import socket
+import struct
+import time
+
+from request import (MPROXY_VERSION, MPROXY_REQUEST, MPROXY_ERROR,
+                     REQUEST_FORMAT, ERROR_FORMAT)
+
+KINDS = ('new', 'echo', 'conflict')
+PERCENTILES = (50, 90, 99, 99.9)
+REQUEST = struct.Struct(REQUEST_FORMAT)
+# Responses and error responses only differ in what the reserved field holds.
+RESPONSE = struct.Struct(ERROR_FORMAT)
+
+
+class Client(object):
+    """One simulated client: a socket bound to its own source address."""
+
+    def __init__(self, address, rip):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, 0))
+        self.sock.setblocking(False)
+        self.rip = rip
+        self.next_rpt = 1
+        # rpt -> dpt of each mapping the daemon has answered with, and the
+        # rpts in a list to choose from.
+        self.mapped = {}
+        self.mapped_rpts = []
+        # rpt -> send times of requests not yet answered
+        self.pending = {}
+
+    def _new_rpt(self):
+        # Once every remote port has been asked for, new requests become
+        # repeats.
+        rpt = self.next_rpt
+        self.next_rpt = rpt % 65535 + 1
+        return rpt
+
+    def send(self, kind, rng, daemon):
+        """Send a request of the given kind. Returns the time it was sent."""
+        if kind == 'echo' and self.mapped_rpts:
+            rpt = rng.choice(self.mapped_rpts)
+            dpt = self.mapped[rpt]
+        elif kind == 'conflict' and self.mapped_rpts:
+            rpt = self._new_rpt()
+            dpt = self.mapped[rng.choice(self.mapped_rpts)]
+        else:
+            rpt = self._new_rpt()
+            dpt = rng.randint(1024, 49151)
+        data = REQUEST.pack(MPROXY_VERSION, MPROXY_REQUEST, self.rip, rpt, dpt)
+        now = time.monotonic()
+        try:
+            self.sock.sendto(data, daemon)
+        except BlockingIOError:
+            return None
+        self.pending.setdefault(rpt, []).append(now)
+        return now
+
+    def receive(self, stats):
+        """Read every response waiting on our socket."""
+        while True:
+            try:
+                data = self.sock.recv(64)
+            except BlockingIOError:
+                return
+            now = time.monotonic()
+            if len(data) != RESPONSE.size:
+                stats.malformed += 1
+                continue
+            version, op, code, rip, rpt, dpt = RESPONSE.unpack(data)
+            # Identical requests waiting on the same rules share a response.
+            sent = self.pending.pop(rpt, None)
+            if sent is None:
+                stats.unexpected += 1
+                continue
+            stats.latencies.extend(now - t for t in sent)
+            if op == MPROXY_ERROR:
+                stats.errors[code] = stats.errors.get(code, 0) + len(sent)
+            elif rpt not in self.mapped:
+                self.mapped[rpt] = dpt
+                self.mapped_rpts.append(rpt)
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.sent = dict.fromkeys(KINDS, 0)
+        self.send_failures = 0
+        self.latencies = []
+        self.errors = {}
+        self.malformed = 0
+        self.unexpected = 0
+
+
+def client_addresses(first, count):
+    """Return count consecutive addresses, starting from first."""
+    base = struct.unpack('!I', socket.inet_aton(first))[0]
+    return [socket.inet_ntoa(struct.pack('!I', base + n))
+            for n in range(count)]
+
+
+def percentile(values, p):
+    """Return percentile p of sorted values."""
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    mix = [float(w) for w in args.mix.split(',')]
+    if len(mix) != len(KINDS) or sum(mix) <= 0:
+        raise SystemExit('--mix takes three weights: new,echo,conflict')
+
+    # One descriptor per client.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = args.clients + 64
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+    rip = socket.inet_aton(args.remote)
+    clients = [Client(address, rip) for address in
+               client_addresses(args.first_client, args.clients)]
+    selector = selectors.DefaultSelector()
+    for client in clients:
+        selector.register(client.sock, selectors.EVENT_READ, client)
+    daemon = (args.daemon, args.port)
+    stats = Stats()
+
+    def poll(timeout):
+        for key, _ in selector.select(timeout):
+            key.data.receive(stats)
+
+    # Requests are sent on a fixed schedule. If we fall behind, we catch up
+    # as fast as we can, so the rate actually sent is reported too.
+    interval = 1.0 / args.rate
+    start = time.monotonic()
+    end = start + args.duration
+    next_send = start
+    while True:
+        now = time.monotonic()
+        if now >= end:
+            break
+        while next_send <= now:
+            kind = rng.choices(KINDS, mix)[0]
+            if rng.choice(clients).send(kind, rng, daemon) is None:
+                stats.send_failures += 1
+            else:
+                stats.sent[kind] += 1
+            next_send += interval
+        poll(max(0.0, min(next_send, end) - time.monotonic()))
+    elapsed = time.monotonic() - start
+
+    # Give the last requests time to be answered.
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline and \
+            any(client.pending for client in clients):
+        poll(max(0.0, deadline - time.monotonic()))
+    for client in clients:
+        client.sock.close()
+    report(stats, elapsed, args.rate)
+
+
+def report(stats, elapsed, rate):
+    sent = sum(stats.sent.values())
+    answered = len(stats.latencies)
+    dropped = sent - answered
+    print('sent {} ({}) in {:.2f}s: {:.0f} req/s (target {:.0f})'.format(
+        sent, ', '.join('{} {}'.format(kind, stats.sent[kind])
+                        for kind in KINDS), elapsed, sent / elapsed, rate))
+    print('answered {} ({:.0f}/s), refused {}, dropped {} ({:.2f}%)'.format(
+        answered, answered / elapsed, sum(stats.errors.values()), dropped,
+        100.0 * dropped / sent if sent else 0.0))
+    if stats.errors:
+        print('refusals by code: ' + ', '.join(
+            '{}: {}'.format(code, count)
+            for code, count in sorted(stats.errors.items())))
+    if stats.send_failures or stats.malformed or stats.unexpected:
+        print('send failures {}, malformed {}, unexpected {}'.format(
+            stats.send_failures, stats.malformed, stats.unexpected))
+    if stats.latencies:
+        latencies = sorted(stats.latencies)
+        print('latency (ms): ' + ' '.join(
+            'p{:g} {:.3f}'.format(p, 1000 * percentile(latencies, p))
+            for p in PERCENTILES) + ' max {:.3f}'.format(1000 * latencies[-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MProxy load generator.')
+    parser.add_argument('--daemon', default='127.0.0.1',
+                        help='address of the daemon')
+    parser.add_argument('--port', type=int, default=45672,
+                        help='UDP port of the daemon')
+    parser.add_argument('--clients', type=int, default=1000,
+                        help='number of simulated clients')
+    parser.add_argument('--first-client', default='127.100.0.1',
+                        help='address of the first client; the others '
+                        'follow it')
+    parser.add_argument('--remote', default='127.0.0.1',
+                        help='rip to request mappings to (each request asks '
+                        'for a different rpt)')
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='requests per second to send')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to send for')
+    parser.add_argument('--mix', default='70,20,10',
+                        help='relative weights of new, echo and conflicting '
+                        'dpt requests')
+    parser.add_argument('--timeout', type=float, default=1,
+                        help='seconds to wait for the last responses')
+    parser.add_argument('--seed', type=int, help='random seed')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
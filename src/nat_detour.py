@@ -8,155 +8,3208 @@ leaves all proxying to the kernel through its built-in NAT support. By
 combining SNAT and DNAT, we can achieve the desired proxy results.
 """
 
-from collections import namedtuple
+from array import array
+from collections import namedtuple, OrderedDict
+import argparse
+import asyncio
+import bisect
+import ctypes
+import json
 import logging
+import logging.handlers
+import math
+import mmap
 import os
+import queue
+import re
+import resource
+import select
+import signal
 import socket
 import struct
-import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 import psutil
 
-# See doc/TERMS.md for definitions of variable names.
-SNAT_COMMAND = (
-    'iptables -t nat -A POSTROUTING -s {cip} -d {rip} -p tcp '
-    '--dport {rpt} -j SNAT --to {dip}'
+# See doc/TERMS.md for definitions of variable names. Our rules are tagged
+# with a comment so that they can be found again by installed(). They live in
+# a pair of chains per client, {pre} and {post}.
+SNAT_RULE = (
+    '{post} -s {cip} -d {rip} -p tcp --dport {rpt} '
+    '-m comment --comment mproxy -j SNAT --to {dip}'
 )
-SNAT_REMOVE_COMMAND = (
-    'iptables -t nat -D POSTROUTING -s {cip} -d {rip} -p tcp '
-    '--dport {rpt} -j SNAT --to {dip}'
+DNAT_RULE = (
+    '{pre} -s {cip} -d {dip} -p tcp --dport {dpt} '
+    '-m comment --comment mproxy -j DNAT --to {rip}:{rpt}'
 )
-DNAT_COMMAND = (
-    'iptables -t nat -A PREROUTING -s {cip} -d {dip} -p tcp '
-    '--dport {dpt} -j DNAT --to {rip}:{rpt}'
+
+# The builtin chains jump to chains of our own, which jump on to the chains of
+# each client by source address. Client chains are named after the client's
+# address in hex.
+PRE_CHAIN = 'MPROXY-PRE'
+POST_CHAIN = 'MPROXY-POST'
+CHAIN_JUMPS = ('PREROUTING -j ' + PRE_CHAIN, 'POSTROUTING -j ' + POST_CHAIN)
+CLIENT_CHAIN = '{}-{:08X}'
+CLIENT_JUMP = '{chain} -s {cip} -j {client_chain}'
+
+# Applies a whole batch of rule changes to the nat table in one transaction.
+# Workers may commit concurrently, so wait for the xtables lock. --wait needs
+# iptables 1.6.2 or later; older versions take no lock and reject the option,
+# so setup() checks for it with a transaction that changes nothing.
+RESTORE_COMMAND = ['iptables-restore', '--noflush', '--wait']
+RESTORE_PROBE = '*nat\nCOMMIT\n'
+SAVE_COMMAND = ['iptables-save', '-t', 'nat']
+RULE_TAG = '--comment mproxy'
+
+# The nftables backend keeps its mappings in two maps, each consulted by a
+# single rule: (cip, dpt) -> (rip, rpt) for DNAT and (cip, rip, rpt) -> dip for
+# SNAT. Only packets addressed to this host are considered for DNAT.
+NFT_COMMAND = ['nft', '-f', '-']
+NFT_TABLE = 'mproxy'
+NFT_RULESET = '''
+table ip mproxy {
+    map dnat_map {
+        type ipv4_addr . inet_service : ipv4_addr . inet_service
+    }
+    map snat_map {
+        type ipv4_addr . ipv4_addr . inet_service : ipv4_addr
+    }
+    chain prerouting {
+        type nat hook prerouting priority -100; policy accept;
+        meta l4proto tcp fib daddr type local dnat ip addr . port to ip saddr . tcp dport map @dnat_map
+    }
+    chain postrouting {
+        type nat hook postrouting priority 100; policy accept;
+        meta l4proto tcp snat ip to ip saddr . ip daddr . tcp dport map @snat_map
+    }
+}
+'''
+NFT_SNAT_ADD = (
+    'add element ip mproxy snat_map {{ {cip} . {rip} . {rpt} : {dip} }}'
+)
+NFT_SNAT_DELETE = (
+    'delete element ip mproxy snat_map {{ {cip} . {rip} . {rpt} }}'
+)
+NFT_DNAT_ADD = (
+    'add element ip mproxy dnat_map {{ {cip} . {dpt} : {rip} . {rpt} }}'
+)
+NFT_DNAT_DELETE = (
+    'delete element ip mproxy dnat_map {{ {cip} . {dpt} }}'
 )
-DNAT_REMOVE_COMMAND = (
-    'iptables -t nat -D PREROUTING -s {cip} -d {dip} -p tcp '
-    '--dport {dpt} -j DNAT --to {rip}:{rpt}'
+# Listing a map shows its elements, which are parsed to find the mappings a
+# previous run left behind.
+NFT_LIST_COMMAND = ['nft', '-n', 'list', 'map', 'ip', NFT_TABLE]
+NFT_DNAT_ELEMENT = re.compile(
+    r'([\d.]+) \. (\d+) : ([\d.]+) \. (\d+)')
+NFT_SNAT_ELEMENT = re.compile(
+    r'([\d.]+) \. ([\d.]+) \. (\d+) : ([\d.]+)')
+
+# With --offload, forwarded packets of our DNATed connections are added to a
+# flowtable, so once established they bypass the rest of the forwarding path.
+# The flowtable starts out on every interface with an address, since kernels
+# before 5.8 can't add devices to it later. Later ones are added as mappings
+# need them, where the kernel can. A set of (cip, dpt) picks out our
+# connections by their original destination. The chain holding the one rule
+# that uses the two is flushed first, so redeclaring it leaves one rule.
+NFT_OFFLOAD_SET = '''
+add set ip mproxy offload_set { type ipv4_addr . inet_service; }
+'''
+NFT_FLOWTABLE = (
+    'add flowtable ip mproxy ft {{ hook ingress priority 0; '
+    'devices = {{ {devices} }}; }}'
+)
+NFT_OFFLOAD_CHAIN = (
+    'add chain ip mproxy forward '
+    '{ type filter hook forward priority 0; policy accept; }\n'
+    'flush chain ip mproxy forward\n'
+    'add rule ip mproxy forward meta l4proto tcp '
+    'ct original ip saddr . ct original proto-dst @offload_set flow add @ft\n'
+)
+NFT_OFFLOAD_ADD = 'add element ip mproxy offload_set {{ {cip} . {dpt} }}'
+NFT_OFFLOAD_DELETE = (
+    'delete element ip mproxy offload_set {{ {cip} . {dpt} }}'
 )
+NFT_FLOWTABLE_DEVICES = re.compile(r'devices = \{?\s*([^};]*?)\s*\}?;')
+
+# Protocol information
+MPROXY_VERSION = 1
+MPROXY_REQUEST = 0
+MPROXY_RESPONSE = 1
+MPROXY_ERROR = 2
+MPROXY_LOAD_QUERY = 3
+MPROXY_LOAD_RESPONSE = 4
+REQUEST_FORMAT = '!BBxx4sHH'
+# Load queries and responses: cpu (per mille of all CPUs), mappings, requests
+# per second and egress kbit/s. Queries are all zeros past the op, and as long
+# as the response, so answering them amplifies nothing.
+LOAD_FORMAT = '!BBHIII'
+# Error responses carry a reason code in the otherwise reserved field.
+ERROR_FORMAT = '!BBH4sHH'
+MPROXY_ERR_EXHAUSTED = 1
+MPROXY_ERR_RATE_LIMITED = 2
+MPROXY_ERR_TOO_MANY = 3
+# Version 2 messages carry a count, then that many records. A response record
+# echoes its request, with the chosen dpt, and an error code (0 on success).
+MPROXY_VERSION_2 = 2
+V2_HEADER_FORMAT = '!BBH'
+V2_RECORD_FORMAT = '!4sHHH'
+MAX_V2_RECORDS = 128
+MAX_DATAGRAM = 2048
+# The same formats, compiled. REQUEST_KEY reads rip as an int, so repeated
+# requests can be looked up without decoding any addresses.
+REQUEST = struct.Struct(REQUEST_FORMAT)
+REQUEST_KEY = struct.Struct('!BBxxIHH')
+ERROR = struct.Struct(ERROR_FORMAT)
+V2_HEADER = struct.Struct(V2_HEADER_FORMAT)
+V2_RECORD = struct.Struct(V2_RECORD_FORMAT)
+LOAD = struct.Struct(LOAD_FORMAT)
+
+# Admission control: each client's request rate is limited by a token bucket.
+# Buckets live in an LRU of bounded size, so spoofed sources can't grow it.
+DEFAULT_CLIENT_BUCKETS = 65536
+
+# IANA suggested
+MIN_EPHEM = 49152
+MAX_EPHEM = 65535
+
+# Rule batching defaults: how long (seconds) a change may wait for company, and
+# how many mappings may share one transaction.
+DEFAULT_BATCH_LATENCY = 0.005
+DEFAULT_BATCH_SIZE = 256
+
+# How long (seconds) a cached route lookup is trusted when we can't hear about
+# routing changes over netlink.
+DEFAULT_ROUTE_TTL = 30.0
+
+# rtnetlink multicast groups and message types (linux/rtnetlink.h) that tell us
+# the answer to ip_for() may have changed.
+NETLINK_ROUTE = 0
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+NLMSG_HEADER = struct.Struct('=IHHII')
+
+# Leases are kept on a timer wheel with this resolution (seconds). When leases
+# expire, mappings with live connections in conntrack are renewed instead.
+# The connections are read in the background this often (seconds).
+LEASE_TICK = 1.0
+DEFAULT_CONNTRACK_REFRESH = 5.0
+PROC_CONNTRACK = '/proc/net/nf_conntrack'
+CONNTRACK_COMMAND = ['conntrack', '-L', '-p', 'tcp']
+
+# Mappings are kept in a MappingTable of this many slots to begin with, which
+# doubles as needed. Its indexes hash integer keys multiplicatively.
+MAPPING_TABLE_INITIAL = 1024
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+HASH_MASK = (1 << 64) - 1
+
+# With --state, mappings are checkpointed to a file of fixed size records so
+# that a restarted daemon can adopt the rules its predecessor left installed.
+# The header holds the number of record slots; each record is (in use, cip,
+# rip, dip, rpt, dpt).
+CHECKPOINT_MAGIC = b'MPXC'
+CHECKPOINT_HEADER = struct.Struct('!4sI')
+CHECKPOINT_RECORD = struct.Struct('!B3x4s4s4sHH')
+CHECKPOINT_INITIAL = 1024
+
+# With --peer, mapping changes are replicated between the daemons of a
+# cluster over UDP. A message is a header (version, kind, record count, the
+# sender's node id, and for snapshots the generation, part number and number
+# of parts) followed by fixed size records (cip, rip, rpt, dpt, and the node id
+# of the mapping's origin). Every node also sends its peers a snapshot of all
+# the mappings it holds this often (seconds), in case changes were lost.
+REPL_VERSION = 1
+REPL_ADD = 0
+REPL_DELETE = 1
+REPL_HELLO = 2
+REPL_SNAPSHOT = 3
+REPL_HEADER = struct.Struct('!BBHIIHH')
+REPL_RECORD = struct.Struct('!4s4sHHI')
+REPL_MAX_RECORDS = 80
+DEFAULT_REPL_PORT = 45673
+DEFAULT_SYNC_INTERVAL = 10.0
+
+# With --workers, each worker binds its own socket to the request port with
+# SO_REUSEPORT, and this classic BPF program makes the kernel deliver each
+# datagram to socket number (source address % workers):
+#   ld [SKF_NET_OFF + 12]; mod #workers; ret a
+SO_ATTACH_REUSEPORT_CBPF = 51
+SKF_NET_OFF = -0x100000
+BPF_LD_W_ABS = 0x20
+BPF_ALU_MOD_K = 0x94
+BPF_RET_A = 0x16
+
+# How often (seconds) the index of listening ports is rebuilt, and the socket
+# tables it is rebuilt from. In these files addresses are hex in host byte
+# order, and state 0A is TCP_LISTEN.
+DEFAULT_LISTEN_REFRESH = 1.0
+PROC_NET_TCP = ('/proc/net/tcp', '/proc/net/tcp6')
+PROC_LISTEN = '0A'
+PROC_LOOPBACK = ('0100007F', '00000000000000000000000001000000')
+
+# The relay backend accepts connections on each dpt itself and splices their
+# bytes to and from the remote through a pipe per direction, at most this many
+# at a time, so payload never enters Python.
+RELAY_CHUNK = 65536
+RELAY_BACKLOG = 128
+
+# How often (seconds) the load reported to clients is sampled. With
+# --workers, each worker publishes its mapping and request counts in a slot of
+# shared memory at every sample, so that the load reported is the detour's.
+DEFAULT_LOAD_INTERVAL = 1.0
+LOAD_BOARD_SLOT = struct.Struct('=QQ')
+
+# SIGUSR1 profiles the daemon for this long (seconds), sampling the stack of
+# every thread this often, and SIGUSR2 logs the size of its tables.
+HOOK_SIGNALS = (signal.SIGUSR1, signal.SIGUSR2)
+DEFAULT_PROFILE_SECONDS = 10.0
+PROFILE_INTERVAL = 0.005
+
+# Log records wait in a queue of at most this many for a thread to write them.
+# Each handled request is logged as one record, whose arguments are the fields
+# named here, so that it can be written as text or as a JSON object.
+DEFAULT_LOG_QUEUE = 10000
+REQUEST_LOG = '%s %s to %s:%d via %d (%d proposed) %.3fms'
+REQUEST_LOG_EXTRA = {
+    'fields': ('verb', 'cip', 'rip', 'rpt', 'dpt', 'proposed', 'ms'),
+}
+
+# Stages of handling a request that are timed, and the bounds (seconds) of the
+# histogram buckets their latencies are counted in. Metrics are served over
+# HTTP in the Prometheus text exposition format.
+METRICS_STAGES = ('parse', 'lookup', 'restrict', 'route', 'install', 'send')
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0)
+METRICS_RESPONSE = (
+    'HTTP/1.0 200 OK\r\n'
+    'Content-Type: text/plain; version=0.0.4\r\n'
+    'Content-Length: {}\r\n\r\n'
+)
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+log.addHandler(ch)
+# Lines logged for each request or mapping, which --log-sample thins out.
+request_log = log.getChild('requests')
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Pass records to other handlers through a queue and a thread of their own.
+
+    Writing to stderr blocks when whatever reads it falls behind, so it is left
+    to a QueueListener thread. Unlike the stock QueueHandler, records are not
+    formatted before they are queued: the thread does that too. Everything we
+    log is immutable, so nothing changes meanwhile. When the queue is full a
+    record is dropped and counted, rather than making the caller wait.
+
+    A forked child must call after_fork() to start a queue and thread of its
+    own, since the parent's thread does not come along (Python 3.7 and later
+    do so at every fork). Closing the handler (logging.shutdown() does, at
+    exit) writes out whatever is still queued.
+    """
+
+    def __init__(self, handlers, size=DEFAULT_LOG_QUEUE):
+        super().__init__(queue.Queue(size))
+        self.handlers = handlers
+        self.dropped = 0
+        self.listener = None
+        self._pid = None
+        self._listen()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.after_fork)
+
+    def _listen(self):
+        self.listener = LogListener(self.queue, *self.handlers)
+        self.listener.start()
+        self._pid = os.getpid()
+
+    def after_fork(self):
+        """Start logging from this process, if it was forked since."""
+        if self.listener is not None and self._pid != os.getpid():
+            # The parent's thread may have held the old queue's lock.
+            self.queue = queue.Queue(self.queue.maxsize)
+            self.dropped = 0
+            self._listen()
+
+    def prepare(self, record):
+        if record.exc_info and not record.exc_text:
+            # A traceback is formatted now, while its frames are as they were.
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            if self.dropped:
+                for handler in self.handlers:
+                    handler.handle(log.makeRecord(
+                        log.name, logging.WARNING, __file__, 0,
+                        'Dropped %d log lines', (self.dropped,), None))
+        super().close()
+
+
+class LogListener(logging.handlers.QueueListener):
+
+    def enqueue_sentinel(self):
+        # Wait for room, rather than fail when stopping with the queue full.
+        self.queue.put(self._sentinel)
+
+
+class SampleFilter(logging.Filter):
+    """Let one in every n records through."""
+
+    def __init__(self, n):
+        super().__init__()
+        self.n = n
+        self._count = 0
+
+    def filter(self, record):
+        self._count += 1
+        if self._count < self.n:
+            return False
+        self._count = 0
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Format records as JSON objects, one per line.
+
+    Records logged with REQUEST_LOG_EXTRA become an object with a member per
+    field. Others have their message in a message member.
+    """
+
+    def format(self, record):
+        entry = {'time': round(record.created, 6), 'level': record.levelname}
+        fields = getattr(record, 'fields', None)
+        if fields is None:
+            entry['message'] = record.getMessage()
+        else:
+            for field, value in zip(fields, record.args):
+                if isinstance(value, float):
+                    value = round(value, 3)
+                elif isinstance(value, str):
+                    value = value.strip()
+                entry[field] = value
+        if record.exc_info or record.exc_text:
+            entry['exception'] = record.exc_text or \
+                self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def setup_logging(verbose=False, json_lines=False, sample=1,
+                  queue_size=DEFAULT_LOG_QUEUE):
+    """
+    Configure logging for serving.
+
+    Debug messages are only made if verbose. Lines are written as JSON objects
+    if json_lines. If sample is more than 1, only one in that many lines
+    about requests and mappings is logged. Unless queue_size is 0, lines are
+    written by a thread, from a queue of at most queue_size.
+    """
+    log.setLevel(logging.DEBUG if verbose else logging.INFO)
+    if json_lines:
+        ch.setFormatter(JSONFormatter())
+    if sample > 1:
+        request_log.addFilter(SampleFilter(sample))
+    if queue_size:
+        log.removeHandler(ch)
+        log.addHandler(LogQueueHandler([ch], queue_size))
+
+
+def logging_after_fork():
+    """Start logging from a forked child, see LogQueueHandler.after_fork()."""
+    for handler in log.handlers:
+        if isinstance(handler, LogQueueHandler):
+            handler.after_fork()
+
+
+def ip_to_int(address):
+    """Return dotted quad address as an int."""
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+def int_to_ip(n):
+    """Return int n as a dotted quad address."""
+    return socket.inet_ntoa(struct.pack('!I', n))
+
+
+def run_command(command, input=None, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL):
+    """
+    Run command, writing input to it, and wait for it to exit.
+
+    Returns its exit status and what it wrote to stdout and stderr (None for
+    those not piped), as text. subprocess.run() needs Python 3.5.
+    """
+    p = subprocess.Popen(command, stdout=stdout, stderr=stderr,
+                         stdin=None if input is None else subprocess.PIPE,
+                         universal_newlines=True)
+    out, err = p.communicate(input)
+    return p.returncode, out, err
+
+
+def ipv4_interfaces():
+    """Return the names of the interfaces with a non-loopback IPv4 address."""
+    return {name for name, addresses in psutil.net_if_addrs().items()
+            if any(a.family == socket.AF_INET and
+                   not a.address.startswith('127.') for a in addresses)}
+
+
+def interface_of(address):
+    """Return the name of the interface with IPv4 address, or None."""
+    for name, addresses in psutil.net_if_addrs().items():
+        for a in addresses:
+            if a.family == socket.AF_INET and a.address == address:
+                return name
+    return None
+
+
+def ip_for(address):
+    """Return the IP address of the interface that routes us to address."""
+
+    # All we do here is connect a UDP socket -- no packet is sent on it. This
+    # has the effect of asking the OS to consult its routing table to see what
+    # interface will get us to `address`. We can find that address from
+    # getsockname() after the fact. Kinda clever, in my opinion.
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.connect((address, 53))
+    addr = s.getsockname()[0]
+    s.close()
+    return addr
+
+
+class RouteCache(object):
+    """
+    Caches ip_for() answers, keyed by destination address.
+
+    The source address toward a remote almost never changes, so there is no
+    need to ask the kernel on every add and delete. When possible, a thread
+    listens for rtnetlink route and address events and empties the cache
+    whenever one arrives. Otherwise, entries simply expire after `ttl` seconds.
+    """
+
+    def __init__(self, ttl=DEFAULT_ROUTE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._cache = {}
+        self._netlink = None
+
+    def start(self):
+        """Begin listening for routing changes, if netlink is available."""
+        try:
+            sk = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                               NETLINK_ROUTE)
+            sk.bind((0, RTMGRP_IPV4_ROUTE | RTMGRP_IPV4_IFADDR))
+        except (AttributeError, OSError) as e:
+            log.warning('No rtnetlink (%s), route cache entries expire after '
+                        '%ss', str(e), self.ttl)
+            return
+        self._netlink = sk
+        t = threading.Thread(target=self._listen, name='route-cache',
+                             daemon=True)
+        t.start()
+
+    def _listen(self):
+        while True:
+            try:
+                data = self._netlink.recv(65536)
+            except OSError as e:
+                # ENOBUFS means we missed events; anything could have changed.
+                log.debug('rtnetlink recv failed: %s', str(e))
+                self.invalidate()
+                continue
+            offset = 0
+            while offset + NLMSG_HEADER.size <= len(data):
+                length, kind, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+                if kind in (RTM_NEWROUTE, RTM_DELROUTE, RTM_NEWADDR,
+                            RTM_DELADDR):
+                    self.invalidate()
+                    break
+                if length < NLMSG_HEADER.size:
+                    break
+                offset += (length + 3) & ~3
+
+    def invalidate(self):
+        """Forget every cached route."""
+        # Rebinding (rather than clearing) means a lookup racing with us can
+        # only ever store its answer in the dictionary being thrown away.
+        self._cache = {}
+        self.invalidations += 1
+
+    def lookup(self, address):
+        """Return the IP address of the interface that routes us to address."""
+        cache = self._cache
+        entry = cache.get(address)
+        now = time.monotonic()
+        if entry is not None and (self._netlink is not None or
+                                  entry[1] > now):
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        addr = ip_for(address)
+        cache[address] = (addr, now + self.ttl)
+        return addr
+
+
+def is_port_open(n):
+    """
+    Return True if there is a TCP server listening on that port.
+
+    This only considers non-loopback servers (i.e. remote address is not
+    127.0.0.1 or ::1).
+    """
+    connections = psutil.net_connections('tcp')
+    for conn in connections:
+        if conn.laddr[0] == '127.0.0.1' or conn.laddr[0] == '::1':
+            # ignore loopback
+            continue
+        if conn.laddr[1] == n and conn.status == psutil.CONN_LISTEN:
+            return True
+    return False
+
+
+def listening_ports():
+    """
+    Return a bytearray, indexed by port, which is 1 for each listening port.
+
+    Like is_port_open(), loopback servers are ignored. This reads the kernel's
+    socket tables directly, falling back to psutil when they are unavailable.
+    """
+    ports = bytearray(65536)
+    try:
+        for path in PROC_NET_TCP:
+            with open(path) as f:
+                next(f)
+                for line in f:
+                    fields = line.split(None, 4)
+                    if fields[3] != PROC_LISTEN:
+                        continue
+                    addr, port = fields[1].split(':')
+                    if addr not in PROC_LOOPBACK:
+                        ports[int(port, 16)] = 1
+    except OSError:
+        for conn in psutil.net_connections('tcp'):
+            if conn.laddr[0] == '127.0.0.1' or conn.laddr[0] == '::1':
+                continue
+            if conn.status == psutil.CONN_LISTEN:
+                ports[conn.laddr[1]] = 1
+    return ports
+
+
+class ListenIndex(object):
+    """
+    Index of non-loopback listening TCP ports, rebuilt in the background.
+
+    Checking a port with is_port_open() walks every TCP socket on the host,
+    which is slow on a busy detour. Instead, a thread rebuilds a bitmap of
+    listening ports every `interval` seconds, so lookups are a single index.
+    The cost of each rebuild is recorded so it can be watched.
+    """
+
+    def __init__(self, interval=DEFAULT_LISTEN_REFRESH):
+        self.interval = interval
+        self.refreshes = 0
+        self.refresh_time = 0.0
+        self.last_refresh_time = 0.0
+        self._ports = bytearray(65536)
+
+    def start(self):
+        """Build the index, then keep rebuilding it in the background."""
+        self.refresh()
+        t = threading.Thread(target=self._run, name='listen-index',
+                             daemon=True)
+        t.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception:
+                log.exception('Failed to refresh listening ports')
+
+    def refresh(self):
+        """Rebuild the index now."""
+        start = time.monotonic()
+        self._ports = listening_ports()
+        elapsed = time.monotonic() - start
+        self.refreshes += 1
+        self.refresh_time += elapsed
+        self.last_refresh_time = elapsed
+
+    def is_open(self, n):
+        """Return True if there is a TCP server listening on port n."""
+        return self._ports[n] == 1
+
+
+class FlowIndex(object):
+    """
+    The (cip, dpt) of every tracked TCP connection, reread in the background.
+
+    Reading conntrack means parsing the whole table, or forking the conntrack
+    tool, which takes a good part of a second on a busy detour. A thread
+    rereads it every `interval` seconds instead, so that expiring leases only
+    looks up the last snapshot. flows is None until conntrack has been read,
+    and again whenever it can't be.
+    """
+
+    def __init__(self, interval=DEFAULT_CONNTRACK_REFRESH):
+        self.interval = interval
+        self.refreshes = 0
+        self.refresh_time = 0.0
+        self.last_refresh_time = 0.0
+        self.flows = None
+
+    def start(self):
+        """Keep rereading conntrack in the background, starting now."""
+        t = threading.Thread(target=self._run, name='flow-index',
+                             daemon=True)
+        t.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                log.exception('Failed to read conntrack')
+            time.sleep(self.interval)
+
+    def refresh(self):
+        """Reread conntrack now."""
+        start = time.monotonic()
+        self.flows = conntrack_flows()
+        elapsed = time.monotonic() - start
+        self.refreshes += 1
+        self.refresh_time += elapsed
+        self.last_refresh_time = elapsed
+
+
+class LoadSampler(object):
+    """
+    Samples CPU load, egress throughput and our request rate in the background.
+
+    Clients ask for these to choose between detours. Answering must be cheap,
+    so a thread takes a sample every `interval` seconds and queries just read
+    the last one. read_requests() returns the number of requests handled so
+    far, from which the rate is worked out.
+    """
+
+    def __init__(self, read_requests, interval=DEFAULT_LOAD_INTERVAL):
+        self.interval = interval
+        # percent of all CPUs, requests per second, bits per second
+        self.cpu = 0.0
+        self.request_rate = 0.0
+        self.egress = 0.0
+        self._read_requests = read_requests
+        self._last = None
+
+    def start(self):
+        """Take a first sample, then keep sampling in the background."""
+        self.sample()
+        t = threading.Thread(target=self._run, name='load-sampler',
+                             daemon=True)
+        t.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+            except Exception:
+                log.exception('Failed to sample load')
+
+    def sample(self):
+        """Take a sample now."""
+        now = time.monotonic()
+        requests = self._read_requests()
+        sent = sum(counters.bytes_sent for nic, counters in
+                   psutil.net_io_counters(pernic=True).items() if nic != 'lo')
+        # Without an interval, this is the load since it was last called.
+        cpu = psutil.cpu_percent(interval=None)
+        if self._last is not None:
+            then, last_requests, last_sent = self._last
+            elapsed = now - then
+            if elapsed > 0:
+                self.request_rate = (requests - last_requests) / elapsed
+                self.egress = (sent - last_sent) * 8 / elapsed
+            self.cpu = cpu
+        self._last = (now, requests, sent)
+
+
+class Profiler(object):
+    """
+    Samples the stacks of our threads, and writes them out folded.
+
+    toggle() starts profiling for `duration` seconds, or stops a profile that
+    is running early. A thread of its own reads the stack of every other thread
+    each `interval` seconds, so the threads profiled carry on undisturbed. Each
+    distinct stack is then written to a file in `directory` as one line: the
+    thread name and the frames from the outermost in, separated by semicolons,
+    followed by the number of samples it was seen in. This is the folded
+    format that flamegraph.pl and speedscope read. Threads waiting count too,
+    so the profile shows where wall clock time goes.
+    """
+
+    def __init__(self, directory=None, duration=DEFAULT_PROFILE_SECONDS,
+                 interval=PROFILE_INTERVAL):
+        self.directory = tempfile.gettempdir() if directory is None \
+            else directory
+        self.duration = duration
+        self.interval = interval
+        self._stop = None
+
+    def toggle(self):
+        """Start profiling, or stop early if we are."""
+        if self._stop is not None:
+            self._stop.set()
+            return
+        self._stop = threading.Event()
+        t = threading.Thread(target=self._run, args=(self._stop,),
+                             name='profiler', daemon=True)
+        t.start()
+
+    def _run(self, stop):
+        path = os.path.join(self.directory, 'mproxy-{}-{}.folded'.format(
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        log.info('Profiling for up to %gs', self.duration)
+        try:
+            stacks, samples = self.sample(stop)
+            with open(path, 'w') as f:
+                for stack, count in sorted(stacks.items()):
+                    f.write('{} {}\n'.format(stack, count))
+            log.info('Wrote %d samples of %d stacks to %s', samples,
+                     len(stacks), path)
+        except Exception:
+            log.exception('Failed to profile')
+        finally:
+            self._stop = None
+
+    def sample(self, stop):
+        """
+        Sample until stop is set or our duration is up. Returns a dict of
+        folded stack -> samples, and the number of samples taken.
+        """
+        me = threading.get_ident()
+        # code object -> frame label, so each function is formatted once
+        labels = {}
+        stacks = {}
+        samples = 0
+        deadline = time.monotonic() + self.duration
+        while not stop.wait(self.interval) and time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = '{} ({}:{})'.format(
+                            code.co_name, os.path.basename(code.co_filename),
+                            code.co_firstlineno)
+                    frames.append(label)
+                    frame = frame.f_back
+                frames.append(names.get(ident, str(ident)))
+                stack = ';'.join(reversed(frames))
+                stacks[stack] = stacks.get(stack, 0) + 1
+            samples += 1
+        return stacks, samples
+
+
+class LoadBoard(object):
+    """
+    Mapping and request counts of every worker, in memory they all share.
+
+    The board is created before the workers are forked. Each then publishes
+    its own counts in its slot, and reads everyone's totals, so that whichever
+    worker a client's load query reaches answers for the whole detour.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        # Anonymous maps are shared with the processes we fork.
+        self._map = mmap.mmap(-1, count * LOAD_BOARD_SLOT.size)
+
+    def publish(self, index, mappings, requests):
+        """Record the counts of worker index."""
+        LOAD_BOARD_SLOT.pack_into(self._map, index * LOAD_BOARD_SLOT.size,
+                                  mappings, requests)
+
+    def totals(self):
+        """Return the mappings and requests of all workers together."""
+        mappings = requests = 0
+        for n in range(self.count):
+            m, r = LOAD_BOARD_SLOT.unpack_from(self._map,
+                                               n * LOAD_BOARD_SLOT.size)
+            mappings += m
+            requests += r
+        return mappings, requests
+
+
+class Histogram(object):
+    """Counts observations in fixed buckets, as a Prometheus histogram."""
+
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is for observations beyond every bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def expose(self, name, labels=''):
+        """Return the exposition lines for this histogram."""
+        lines = []
+        total = 0
+        sep = ',' if labels else ''
+        for le, count in zip(self.buckets + ('+Inf',), list(self.counts)):
+            total += count
+            lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(
+                name, labels, sep, le, total))
+        labels = '{' + labels + '}' if labels else ''
+        lines.append('{}_sum{} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{} {}'.format(name, labels, total))
+        return lines
+
+
+class Metrics(object):
+    """
+    Request counters and latency histograms, served to Prometheus.
+
+    MProxy times each stage of handling a request and the whole request, and
+    counts verbs and errors. Anything else worth watching is registered as a
+    callable that is read when the metrics are scraped. If an address is given,
+    start() serves the metrics from a thread, over TCP (host:port) or a Unix
+    socket (any address containing a /).
+    """
+
+    def __init__(self, address=None):
+        self.address = address
+        self.requests = Histogram()
+        self.stages = {stage: Histogram() for stage in METRICS_STAGES}
+        self.verbs = {}
+        self.errors = {}
+        self._values = []
+
+    def observe(self, stage, seconds):
+        """Record that a stage of handling a request took this long."""
+        self.stages[stage].observe(seconds)
+
+    def count_verb(self, verb):
+        self.verbs[verb] = self.verbs.get(verb, 0) + 1
+
+    def count_error(self, error):
+        name = type(error).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def register(self, name, kind, help, read):
+        """Expose read() as metric name, a 'counter' or 'gauge'."""
+        self._values.append((name, kind, help, read))
+
+    def expose(self):
+        """Return every metric, in the Prometheus text format."""
+        lines = [
+            '# HELP mproxy_request_seconds Time to handle a request datagram.',
+            '# TYPE mproxy_request_seconds histogram',
+        ]
+        lines += self.requests.expose('mproxy_request_seconds')
+        lines += [
+            '# HELP mproxy_stage_seconds Time spent in each stage of a '
+            'request.',
+            '# TYPE mproxy_stage_seconds histogram',
+        ]
+        for stage in METRICS_STAGES:
+            lines += self.stages[stage].expose(
+                'mproxy_stage_seconds', 'stage="{}"'.format(stage))
+        for name, label, counts, help in (
+                ('mproxy_requests_total', 'verb', self.verbs,
+                 'Requests handled, by verb.'),
+                ('mproxy_errors_total', 'type', self.errors,
+                 'Requests failed, by error.')):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} counter'.format(name))
+            for key, count in sorted(counts.items()):
+                lines.append('{}{{{}="{}"}} {}'.format(name, label, key,
+                                                       count))
+        for name, kind, help, read in self._values:
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.append('{} {}'.format(name, read()))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def start(self):
+        """Begin serving the metrics, if we have an address."""
+        if self.address is None:
+            return
+        if '/' in self.address:
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+            sk = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sk.bind(self.address)
+        else:
+            host, port = self.address.rsplit(':', 1)
+            sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sk.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sk.bind((host or '127.0.0.1', int(port)))
+        sk.listen(8)
+        t = threading.Thread(target=self._serve, args=(sk,), name='metrics',
+                             daemon=True)
+        t.start()
+        log.info('Serving metrics on %s', self.address)
+
+    def _serve(self, sk):
+        # Whatever is asked for, the answer is the metrics.
+        while True:
+            conn, _ = sk.accept()
+            with conn:
+                try:
+                    conn.settimeout(1.0)
+                    conn.recv(4096)
+                    body = self.expose().encode()
+                    conn.sendall(METRICS_RESPONSE.format(len(body)).encode()
+                                 + body)
+                except OSError:
+                    pass
+                except Exception:
+                    log.exception('Failed to serve metrics')
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timing wheel, for expiring many timers cheaply.
+
+    Time is divided into ticks of `resolution` seconds. Level 0 has one slot
+    per tick for the next 2**bits ticks; each higher level has slots covering
+    2**bits times as many ticks as the level below. Timers are placed in the
+    lowest level which can hold them, and fall ("cascade") into lower levels
+    as their time approaches. Scheduling is O(1), and so is each tick,
+    amortized over the timers it expires.
+    """
+
+    def __init__(self, resolution=LEASE_TICK, bits=6, levels=4):
+        self.resolution = resolution
+        self._bits = bits
+        self._mask = (1 << bits) - 1
+        self._span = 1 << (bits * levels)
+        self._wheels = [[[] for _ in range(1 << bits)] for _ in range(levels)]
+        self._tick = int(time.monotonic() / resolution)
+        self._count = 0
+
+    def __len__(self):
+        """Return the number of timers scheduled."""
+        return self._count
+
+    def schedule(self, key, when):
+        """Arrange for advance() to return key once time `when` has passed."""
+        tick = max(int(math.ceil(when / self.resolution)), self._tick + 1)
+        self._insert(key, tick)
+
+    def _insert(self, key, tick):
+        # Timers too far out wait in the top level's furthest slot, and are
+        # placed again when they cascade.
+        place = min(tick, self._tick + self._span - 1)
+        delta = place - self._tick
+        level = 0
+        while delta >> (self._bits * (level + 1)):
+            level += 1
+        slot = (place >> (self._bits * level)) & self._mask
+        self._wheels[level][slot].append((key, tick))
+        self._count += 1
+
+    def next_time(self):
+        """Return the time of the next tick."""
+        return (self._tick + 1) * self.resolution
+
+    def advance(self, now):
+        """Move the wheel forward to time now, returning the expired keys."""
+        target = int(now / self.resolution)
+        if self._count == 0:
+            self._tick = max(self._tick, target)
+            return []
+        expired = []
+        while self._tick < target:
+            self._tick += 1
+            for level in range(1, len(self._wheels)):
+                if self._tick & ((1 << (self._bits * level)) - 1):
+                    break
+                slot = (self._tick >> (self._bits * level)) & self._mask
+                entries = self._wheels[level][slot]
+                self._wheels[level][slot] = []
+                self._count -= len(entries)
+                for key, tick in entries:
+                    self._insert(key, tick)
+            slot = self._tick & self._mask
+            entries = self._wheels[0][slot]
+            self._wheels[0][slot] = []
+            self._count -= len(entries)
+            expired.extend(key for key, tick in entries)
+        return expired
+
+
+def conntrack_flows():
+    """
+    Return the (source, destination port) of each tracked TCP connection.
+
+    Addresses and ports are as the connection was originally addressed, i.e.
+    (cip, dpt) for detoured connections. Returns None if conntrack can't be
+    read, either from procfs or the conntrack tool.
+    """
+    try:
+        with open(PROC_CONNTRACK) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        try:
+            status, out, err = run_command(CONNTRACK_COMMAND)
+        except OSError:
+            return None
+        if status != 0:
+            return None
+        lines = out.splitlines()
+    flows = set()
+    for line in lines:
+        src = dport = None
+        for field in line.split():
+            if src is None and field.startswith('src='):
+                src = field[4:]
+            elif dport is None and field.startswith('dport='):
+                dport = int(field[6:])
+                break
+        if src is not None and dport is not None:
+            flows.add((src, dport))
+    return flows
+
+
+Request = namedtuple('Request', ['rip', 'rpt', 'dpt', 'cip'])
+
+
+class MProxyError(Exception):
+    pass
+
+
+class MProxyRefused(MProxyError):
+    """A well-formed request we will not satisfy. The client is told why."""
+    code = None
+
+
+class PortsExhausted(MProxyRefused):
+    code = MPROXY_ERR_EXHAUSTED
+
+
+class RateLimited(MProxyRefused):
+    code = MPROXY_ERR_RATE_LIMITED
+
+
+class TooManyMappings(MProxyRefused):
+    code = MPROXY_ERR_TOO_MANY
+
+
+class TokenBuckets(object):
+    """
+    Limits each client to `rate` requests a second, in bursts of up to `burst`.
+
+    Buckets are kept in an LRU of at most `size` clients, so a flood from
+    spoofed addresses evicts buckets rather than growing memory. An evicted
+    client comes back with a full bucket, erring on the side of admitting.
+    """
+
+    def __init__(self, rate, burst=None, size=DEFAULT_CLIENT_BUCKETS):
+        self.rate = rate
+        self.burst = max(1.0, rate) if burst is None else burst
+        self.size = size
+        self.evictions = 0
+        # cip -> [tokens, time they were counted]
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def admit(self, cip, cost=1):
+        """Take cost tokens from the client's bucket, if it has that many."""
+        now = time.monotonic()
+        bucket = self._buckets.get(cip)
+        if bucket is None:
+            if len(self._buckets) >= self.size:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+            bucket = self._buckets[cip] = [self.burst, now]
+        else:
+            self._buckets.move_to_end(cip)
+            tokens = bucket[0] + (now - bucket[1]) * self.rate
+            bucket[0] = min(self.burst, tokens)
+            bucket[1] = now
+        if bucket[0] < cost:
+            return False
+        bucket[0] -= cost
+        return True
+
+
+class _ClientPorts(object):
+    __slots__ = ('bitmap', 'others', 'released', 'cursor', 'used',
+                 'ephemeral')
+
+    def __init__(self, size, cursor):
+        # One bit per port of the ephemeral range, and a set of the ports
+        # outside it that the client asked for.
+        self.bitmap = bytearray((size + 7) // 8)
+        self.others = set()
+        self.released = []
+        self.cursor = cursor
+        self.used = 0
+        self.ephemeral = 0
+
+
+class PortAllocator(object):
+    """
+    Tracks which detour ports each client is using, and chooses new ones.
+
+    Each client gets a bitmap covering the ephemeral range (2KB for the
+    default), so checking or claiming a port is O(1). Ports outside the range
+    are only used when a client asks for them, and are kept in a set. New
+    ports come from the ephemeral range: ports the client released are reused
+    first, and otherwise a cursor sweeps the range, skipping a byte's worth of
+    used ports at a time. Allocation is therefore O(1) amortized, and a full
+    range is reported rather than retried forever.
+    """
+
+    def __init__(self, low=MIN_EPHEM, high=MAX_EPHEM):
+        self.low = low
+        self.high = high
+        self._clients = {}
+
+    def __len__(self):
+        """Return the number of clients holding ports."""
+        return len(self._clients)
+
+    def count(self, cip):
+        """Return the number of ports used by the client."""
+        c = self._clients.get(cip)
+        return 0 if c is None else c.used
+
+    def nbytes(self):
+        """Return the bytes taken by the bitmaps."""
+        return len(self._clients) * ((self.high - self.low + 8) // 8)
+
+    def occupancy(self):
+        """
+        Return the number of ports used by all clients, and the fraction of
+        the ephemeral range used by the client using most of it.
+        """
+        used = 0
+        most = 0
+        # Called from another thread, so iterate over a copy.
+        for c in list(self._clients.values()):
+            used += c.used
+            most = max(most, c.ephemeral)
+        return used, most / (self.high - self.low + 1)
+
+    def is_used(self, cip, port):
+        """Return True if the client already has a mapping on port."""
+        c = self._clients.get(cip)
+        if c is None:
+            return False
+        if not self.low <= port <= self.high:
+            return port in c.others
+        n = port - self.low
+        return bool(c.bitmap[n >> 3] & (1 << (n & 7)))
+
+    def claim(self, cip, port):
+        """Mark port as used by the client."""
+        c = self._clients.get(cip)
+        if c is None:
+            c = self._clients[cip] = _ClientPorts(self.high - self.low + 1,
+                                                  self.low)
+        if not self.low <= port <= self.high:
+            if port not in c.others:
+                c.others.add(port)
+                c.used += 1
+            return
+        n = port - self.low
+        bit = 1 << (n & 7)
+        if c.bitmap[n >> 3] & bit:
+            return
+        c.bitmap[n >> 3] |= bit
+        c.used += 1
+        c.ephemeral += 1
+
+    def release(self, cip, port):
+        """Return port to the client's pool of free ports."""
+        c = self._clients.get(cip)
+        if c is None:
+            return
+        if not self.low <= port <= self.high:
+            if port not in c.others:
+                return
+            c.others.discard(port)
+        else:
+            n = port - self.low
+            bit = 1 << (n & 7)
+            if not c.bitmap[n >> 3] & bit:
+                return
+            c.bitmap[n >> 3] &= ~bit
+            c.ephemeral -= 1
+            c.released.append(port)
+        c.used -= 1
+        if c.used == 0:
+            del self._clients[cip]
+
+    def choose(self, cip, restricted):
+        """
+        Return an ephemeral port which is free for the client.
+
+        Ports for which restricted(port) is true are skipped. The port is not
+        claimed. Raises PortsExhausted if there is no such port.
+        """
+        c = self._clients.get(cip)
+        if c is None:
+            c = self._clients[cip] = _ClientPorts(self.high - self.low + 1,
+                                                  self.low)
+        span = self.high - self.low + 1
+        if c.ephemeral >= span:
+            raise PortsExhausted('No free ports for {}'.format(cip))
+        bitmap = c.bitmap
+        low = self.low
+        # Released ports may since have been claimed again by request, so
+        # check them; restricted ones will turn up again in the sweep.
+        while c.released:
+            port = c.released.pop()
+            n = port - low
+            if not bitmap[n >> 3] & (1 << (n & 7)) and not restricted(port):
+                return port
+        n = c.cursor - low
+        remaining = span
+        while remaining > 0:
+            if n & 7 == 0 and bitmap[n >> 3] == 0xFF and n + 7 < span:
+                n += 8
+                remaining -= 8
+            else:
+                free = not bitmap[n >> 3] & (1 << (n & 7))
+                if free and not restricted(n + low):
+                    c.cursor = n + low + 1 if n + 1 < span else low
+                    return n + low
+                n += 1
+                remaining -= 1
+            if n >= span:
+                n = 0
+        c.cursor = n + low
+        raise PortsExhausted('No unrestricted ports for {}'.format(cip))
+
+
+class MappingTable(object):
+    """
+    Every mapping, packed as integers into arrays, with two hash indexes.
+
+    A mapping occupies a slot: the same position in arrays of cip, rip and dip
+    (as 32 bit integers) and of rpt and dpt (16 bits), 16 bytes in all. Freed
+    slots are reused. Two open addressing indexes, each an array of slot
+    numbers kept at most half full, find a mapping by (cip, rip, rpt) and by
+    (cip, dpt). Probing is linear, and deleting shifts later entries back
+    rather than leaving tombstones. A million mappings take under 40MB, against
+    several hundred bytes each as dicts of Request tuples.
+
+    Mappings go in and come out as Request tuples, so this can stand in for a
+    dict of mapping -> dip. Iterating walks the slots; copy it first if the
+    table will change meanwhile.
+    """
+
+    def __init__(self, capacity=MAPPING_TABLE_INITIAL):
+        self._len = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self._cip = array('I', [0]) * capacity
+        self._rip = array('I', [0]) * capacity
+        self._dip = array('I', [0]) * capacity
+        self._rpt = array('H', [0]) * capacity
+        self._dpt = array('H', [0]) * capacity
+        self._used = bytearray(capacity)
+        self._free = array('I', range(capacity - 1, -1, -1))
+        # Indexes have twice as many positions as there are slots, a power of
+        # two; -1 marks an empty position.
+        self._bits = (2 * capacity - 1).bit_length()
+        self._by_rem = array('i', [-1]) * (1 << self._bits)
+        self._by_dpt = array('i', [-1]) * (1 << self._bits)
+
+    def _grow(self):
+        old = (self._cip, self._rip, self._dip, self._rpt, self._dpt,
+               self._used)
+        self._allocate(2 * len(self._cip))
+        capacity = len(old[0])
+        self._cip[:capacity] = old[0]
+        self._rip[:capacity] = old[1]
+        self._dip[:capacity] = old[2]
+        self._rpt[:capacity] = old[3]
+        self._dpt[:capacity] = old[4]
+        self._used[:capacity] = old[5]
+        # Every old slot is in use, so only the new ones are free.
+        del self._free[len(self._free) - capacity:]
+        for slot in range(capacity):
+            self._insert(self._by_rem, self._rem_pos(slot), slot)
+            self._insert(self._by_dpt, self._dpt_pos(slot), slot)
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def capacity(self):
+        """Return the number of slots, used or free."""
+        return len(self._cip)
+
+    def nbytes(self):
+        """Return the bytes taken by the arrays."""
+        return sum(len(a) * a.itemsize for a in (
+            self._cip, self._rip, self._dip, self._rpt, self._dpt,
+            self._free, self._by_rem, self._by_dpt)) + len(self._used)
+
+    def _hash(self, key):
+        # Multiplying only carries low bits upwards, so fold the product back
+        # down and multiply again before taking the top bits.
+        key = (key ^ key >> 64) * HASH_MULTIPLIER & HASH_MASK
+        return ((key ^ key >> 32) * HASH_MULTIPLIER & HASH_MASK) >> \
+            (64 - self._bits)
+
+    def _rem_pos(self, slot):
+        return self._hash(self._cip[slot] << 48 | self._rip[slot] << 16 |
+                          self._rpt[slot])
+
+    def _dpt_pos(self, slot):
+        return self._hash(self._cip[slot] << 16 | self._dpt[slot])
+
+    def _find_rem(self, cip, rip, rpt):
+        # Returns the index position of (cip, rip, rpt), and its slot or -1.
+        index = self._by_rem
+        mask = len(index) - 1
+        pos = self._hash(cip << 48 | rip << 16 | rpt)
+        while True:
+            slot = index[pos]
+            if slot < 0 or (self._cip[slot] == cip and
+                            self._rpt[slot] == rpt and
+                            self._rip[slot] == rip):
+                return pos, slot
+            pos = (pos + 1) & mask
+
+    def _find_dpt(self, cip, dpt):
+        index = self._by_dpt
+        mask = len(index) - 1
+        pos = self._hash(cip << 16 | dpt)
+        while True:
+            slot = index[pos]
+            if slot < 0 or (self._cip[slot] == cip and
+                            self._dpt[slot] == dpt):
+                return pos, slot
+            pos = (pos + 1) & mask
+
+    @staticmethod
+    def _insert(index, pos, slot):
+        mask = len(index) - 1
+        while index[pos] >= 0:
+            pos = (pos + 1) & mask
+        index[pos] = slot
+
+    def _erase(self, index, pos, home):
+        # Empties pos, then moves back any later entry of the cluster that
+        # could no longer be reached from its home position.
+        mask = len(index) - 1
+        while True:
+            index[pos] = -1
+            scan = pos
+            while True:
+                scan = (scan + 1) & mask
+                slot = index[scan]
+                if slot < 0:
+                    return
+                want = home(slot)
+                # Moving is needed if want lies cyclically outside
+                # (pos, scan].
+                if (scan - want) & mask >= (scan - pos) & mask:
+                    index[pos] = slot
+                    pos = scan
+                    break
+
+    def _slot(self, i):
+        return self._find_rem(ip_to_int(i.cip), ip_to_int(i.rip), i.rpt)[1]
+
+    def _request(self, slot):
+        return Request(rip=int_to_ip(self._rip[slot]), rpt=self._rpt[slot],
+                       dpt=self._dpt[slot], cip=int_to_ip(self._cip[slot]))
+
+    def add(self, i, dip):
+        """Add mapping i, which must not share its remote or dpt with another."""
+        if not self._free:
+            self._grow()
+        cip = ip_to_int(i.cip)
+        rip = ip_to_int(i.rip)
+        slot = self._free.pop()
+        self._cip[slot] = cip
+        self._rip[slot] = rip
+        self._dip[slot] = ip_to_int(dip)
+        self._rpt[slot] = i.rpt
+        self._dpt[slot] = i.dpt
+        self._used[slot] = 1
+        self._insert(self._by_rem, self._find_rem(cip, rip, i.rpt)[0], slot)
+        self._insert(self._by_dpt, self._find_dpt(cip, i.dpt)[0], slot)
+        self._len += 1
+
+    def remove(self, i):
+        """Remove mapping i. Raises KeyError if it is not in the table."""
+        cip = ip_to_int(i.cip)
+        pos, slot = self._find_rem(cip, ip_to_int(i.rip), i.rpt)
+        if slot < 0 or self._dpt[slot] != i.dpt:
+            raise KeyError(i)
+        self._erase(self._by_rem, pos, self._rem_pos)
+        self._erase(self._by_dpt, self._find_dpt(cip, i.dpt)[0],
+                    self._dpt_pos)
+        self._used[slot] = 0
+        self._free.append(slot)
+        self._len -= 1
+
+    def get(self, i, default=None):
+        """Return the dip of mapping i, or default."""
+        slot = self._slot(i)
+        if slot < 0 or self._dpt[slot] != i.dpt:
+            return default
+        return int_to_ip(self._dip[slot])
+
+    def __getitem__(self, i):
+        dip = self.get(i)
+        if dip is None:
+            raise KeyError(i)
+        return dip
+
+    def __contains__(self, i):
+        return self.get(i) is not None
+
+    def __iter__(self):
+        used = self._used
+        for slot in range(len(used)):
+            if used[slot]:
+                yield self._request(slot)
+
+    def dpt_for(self, cip, rip, rpt):
+        """Return the dpt of the client's mapping to (rip, rpt), or None."""
+        slot = self._find_rem(ip_to_int(cip), ip_to_int(rip), rpt)[1]
+        return None if slot < 0 else self._dpt[slot]
+
+    def remote_for(self, cip, dpt):
+        """Return (rip, rpt) of the client's mapping on dpt, or None."""
+        slot = self._find_dpt(ip_to_int(cip), dpt)[1]
+        if slot < 0:
+            return None
+        return int_to_ip(self._rip[slot]), self._rpt[slot]
+
+
+class Checkpoint(object):
+    """
+    Mappings saved to a file of fixed size records, for warm restarts.
+
+    The file is memory mapped, so saving or dropping a mapping is a single
+    record write into the page cache rather than a system call, and the kernel
+    still writes it back if we crash. Freed slots are reused, and the file
+    doubles in size when it fills up.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._map = None
+        self._capacity = 0
+        self._slots = {}
+        self._free = []
+
+    def __len__(self):
+        return len(self._slots)
+
+    def open(self):
+        """
+        Open the file, returning the (request, dip) pairs saved in it.
+
+        The records stay where they are, so that a crash before the caller has
+        reconciled them with the kernel loses nothing. The caller then saves
+        the mappings it keeps, which rewrites their records in place, and
+        removes the rest.
+        """
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        saved, repeated = self._load()
+        self._resize(max(CHECKPOINT_INITIAL, self._capacity))
+        for slot in repeated:
+            self._map[self._offset(slot)] = 0
+        return saved
+
+    def _load(self):
+        # Takes over the file's slots as they are, or empties it if it holds
+        # no checkpoint. Also returns the slots holding a mapping saved in an
+        # earlier slot too, which are free.
+        size = os.fstat(self._fd).st_size
+        if size < CHECKPOINT_HEADER.size:
+            os.ftruncate(self._fd, 0)
+            return [], []
+        saved = []
+        repeated = []
+        with mmap.mmap(self._fd, size, access=mmap.ACCESS_READ) as m:
+            magic, count = CHECKPOINT_HEADER.unpack_from(m)
+            if magic != CHECKPOINT_MAGIC:
+                log.warning('Ignoring %s, which is not a checkpoint',
+                            self.path)
+                os.ftruncate(self._fd, 0)
+                return [], []
+            count = min(count, (size - CHECKPOINT_HEADER.size) //
+                        CHECKPOINT_RECORD.size)
+            for slot in range(count):
+                used, cip, rip, dip, rpt, dpt = \
+                    CHECKPOINT_RECORD.unpack_from(m, self._offset(slot))
+                if not used:
+                    continue
+                i = Request(rip=socket.inet_ntoa(rip), rpt=rpt, dpt=dpt,
+                            cip=socket.inet_ntoa(cip))
+                if i in self._slots:
+                    repeated.append(slot)
+                else:
+                    self._slots[i] = slot
+                    saved.append((i, socket.inet_ntoa(dip)))
+        # Whatever follows the last slot is not ours; growing from here on
+        # must only add empty slots.
+        os.ftruncate(self._fd, self._offset(count))
+        taken = set(self._slots.values())
+        # Slots are popped from the end, so hand out low slots first.
+        self._free = [slot for slot in range(count - 1, -1, -1)
+                      if slot not in taken]
+        self._capacity = count
+        return saved, repeated
+
+    def _offset(self, slot):
+        return CHECKPOINT_HEADER.size + slot * CHECKPOINT_RECORD.size
+
+    def _resize(self, capacity):
+        # Growing the file keeps the records already written to it.
+        if self._map is not None:
+            self._map.close()
+        size = self._offset(capacity)
+        os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        CHECKPOINT_HEADER.pack_into(self._map, 0, CHECKPOINT_MAGIC, capacity)
+        # Slots are popped from the end, so hand out low slots first.
+        self._free[:0] = range(capacity - 1, self._capacity - 1, -1)
+        self._capacity = capacity
+
+    def add(self, i, dip):
+        """Save mapping i, installed with SNAT address dip."""
+        slot = self._slots.get(i)
+        if slot is None:
+            if not self._free:
+                self._resize(2 * self._capacity)
+            slot = self._free.pop()
+            self._slots[i] = slot
+        CHECKPOINT_RECORD.pack_into(
+            self._map, self._offset(slot), 1, socket.inet_aton(i.cip),
+            socket.inet_aton(i.rip), socket.inet_aton(dip), i.rpt, i.dpt)
+
+    def remove(self, i):
+        """Drop mapping i, if saved."""
+        slot = self._slots.pop(i, None)
+        if slot is not None:
+            self._map[self._offset(slot)] = 0
+            self._free.append(slot)
+
+    def close(self):
+        """Write everything back to the file and close it."""
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            os.close(self._fd)
+            self._map = self._fd = None
+
+
+class Replicator(object):
+    """
+    Carries mapping changes between the daemons of a cluster.
+
+    Each node is known by a 32 bit node id, by default the address it reaches
+    its first peer from. Changes are sent to every peer as they are committed,
+    so all nodes must be listed as each other's peers. Datagrams from
+    addresses that are not peers are ignored.
+
+    Since datagrams may be lost, a snapshot of every mapping held is also sent
+    every interval seconds, split into parts that are only acted on once all
+    have arrived. On starting we say hello, and peers answer with a snapshot
+    straight away, so a restarted node learns the cluster's mappings before
+    sending snapshots of its own (until then it is recovering).
+    """
+
+    def __init__(self, peers, port=DEFAULT_REPL_PORT, node=None,
+                 interval=DEFAULT_SYNC_INTERVAL):
+        self.peers = peers
+        self.port = port
+        self.node = node
+        self.interval = interval
+        self.sock = None
+        self.recovering = True
+        self._addresses = set()
+        self._generation = 0
+        self._next_sync = None
+        # node -> (generation, parts, {part: records}) of snapshots still
+        # arriving
+        self._snapshots = {}
+        self.sent = 0
+        self.received = 0
+
+    def start(self):
+        """Bind our socket and say hello to our peers."""
+        self.peers = [(socket.gethostbyname(host), port)
+                      for host, port in self.peers]
+        self._addresses = {host for host, port in self.peers}
+        if self.node is None:
+            self.node = ip_to_int(ip_for(self.peers[0][0]))
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('0.0.0.0', self.port))
+        self.sock.setblocking(False)
+        self._next_sync = time.monotonic() + self.interval
+        log.info('Replicating as node %d to %s', self.node, ', '.join(
+            '{}:{}'.format(host, port) for host, port in self.peers))
+        self.send(REPL_HELLO, [])
+
+    def close(self):
+        """Stop replicating. Our peers keep the mappings they were sent."""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def timeout(self):
+        """Return how long until the next snapshot is due, if replicating."""
+        if self.sock is None:
+            return None
+        return max(0.0, self._next_sync - time.monotonic())
+
+    def due(self):
+        return self.sock is not None and time.monotonic() >= self._next_sync
+
+    def _messages(self, kind, records, generation=0):
+        chunks = [records[n:n + REPL_MAX_RECORDS]
+                  for n in range(0, len(records), REPL_MAX_RECORDS)] or [[]]
+        for part, chunk in enumerate(chunks):
+            parts = [REPL_HEADER.pack(REPL_VERSION, kind, len(chunk),
+                                      self.node, generation, part,
+                                      len(chunks))]
+            for i, origin in chunk:
+                parts.append(REPL_RECORD.pack(
+                    socket.inet_aton(i.cip), socket.inet_aton(i.rip), i.rpt,
+                    i.dpt, origin))
+            yield b''.join(parts)
+
+    def send(self, kind, records, peers=None, generation=0):
+        """Send records, a list of (mapping, origin), to peers (or all)."""
+        if self.sock is None:
+            return
+        for data in self._messages(kind, records, generation):
+            for peer in peers or self.peers:
+                try:
+                    self.sock.sendto(data, peer)
+                    self.sent += 1
+                except OSError as e:
+                    log.warning('Replication to %s:%d failed: %s',
+                                peer[0], peer[1], str(e))
+
+    def snapshot(self, records, peers=None):
+        """Send a snapshot of records to peers, or all of them if it is due."""
+        self._generation += 1
+        self.send(REPL_SNAPSHOT, records, peers, self._generation)
+        if peers is None:
+            self._next_sync = time.monotonic() + self.interval
+            self.recovering = False
+
+    def _decode(self, data):
+        if len(data) < REPL_HEADER.size:
+            raise MProxyError('Replication message length ({}) is shorter '
+                              'than a header'.format(len(data)))
+        version, kind, count, node, generation, part, parts = \
+            REPL_HEADER.unpack_from(data)
+        if version != REPL_VERSION:
+            raise MProxyError('Replication version ({}) does not match '
+                              'expected ({})'.format(version, REPL_VERSION))
+        if kind > REPL_SNAPSHOT or part >= parts:
+            raise MProxyError('Replication message kind ({}) or part ({} of '
+                              '{}) is invalid'.format(kind, part, parts))
+        if len(data) != REPL_HEADER.size + count * REPL_RECORD.size:
+            raise MProxyError('Replication message length ({}) does not '
+                              'match {} records'.format(len(data), count))
+        records = []
+        for offset in range(REPL_HEADER.size, len(data), REPL_RECORD.size):
+            cip, rip, rpt, dpt, origin = REPL_RECORD.unpack_from(data, offset)
+            records.append((Request(rip=socket.inet_ntoa(rip), rpt=rpt,
+                                    dpt=dpt, cip=socket.inet_ntoa(cip)),
+                            origin))
+        return kind, node, generation, part, parts, records
+
+    def _assemble(self, node, generation, part, parts, records):
+        # Returns the whole snapshot once its last part arrives. A part of a
+        # newer snapshot abandons the rest of an older one.
+        held = self._snapshots.get(node)
+        if held is None or held[:2] != (generation, parts):
+            held = (generation, parts, {})
+            self._snapshots[node] = held
+        held[2][part] = records
+        if len(held[2]) < parts:
+            return None
+        del self._snapshots[node]
+        return [r for n in range(parts) for r in held[2][n]]
+
+    def receive(self):
+        """Yield (kind, node, records, address) for each message waiting."""
+        while self.sock is not None:
+            try:
+                data, addr = self.sock.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            if addr[0] not in self._addresses:
+                log.warning('Ignoring replication from %s, not a peer',
+                            addr[0])
+                continue
+            try:
+                kind, node, generation, part, parts, records = \
+                    self._decode(data)
+            except MProxyError as e:
+                log.error('Encountered exception (%s) while handling '
+                          'replication from %r.', str(e), addr)
+                continue
+            self.received += 1
+            if kind == REPL_SNAPSHOT:
+                records = self._assemble(node, generation, part, parts,
+                                         records)
+                if records is None:
+                    continue
+            yield kind, node, records, addr
+
+
+class NATBackend(object):
+    """
+    Interface between MProxy and the kernel's NAT configuration.
+
+    Mapping changes are queued with add() and delete() and applied together by
+    commit(), which must be atomic: either every queued change lands or none
+    do. The base class keeps the queue and decides when a batch is due;
+    subclasses implement apply() for a particular kernel interface.
+    """
+
+    name = None
+
+    def __init__(self, max_latency=DEFAULT_BATCH_LATENCY,
+                 max_size=DEFAULT_BATCH_SIZE):
+        self.max_latency = max_latency
+        self.max_size = max_size
+        self._ops = []
+        self._opened = None
+
+    def __len__(self):
+        """Return the number of mapping changes waiting to be committed."""
+        return len(self._ops)
+
+    def setup(self, warm=False):
+        """
+        Prepare the kernel for NAT. Called once before serving.
+
+        If warm, mappings left installed by a previous run are kept, for the
+        restarted MProxy to reconcile with its checkpoint.
+        """
+        # ensure that we are configured to forward packets
+        os.system('sysctl -w net.ipv4.ip_forward=1')
+
+    def teardown(self):
+        """Remove anything setup() created. Called once after clean up."""
+        pass
+
+    def purge(self):
+        """Remove every mapping installed by any MProxy, recorded or not."""
+        raise NotImplementedError()
+
+    def installed(self):
+        """
+        Return a dict of request to dip for every mapping found in the kernel.
+
+        Like purge(), this includes mappings installed by any MProxy. Only
+        mappings with both their SNAT and DNAT in place are returned.
+        """
+        raise NotImplementedError()
+
+    def owns_port(self, n):
+        """Return True if we are the TCP server listening on port n."""
+        return False
+
+    def claim_port(self, n):
+        """
+        Return False if port n cannot be used as a dpt.
+
+        Called as a dpt is chosen for a new mapping. Backends which listen on
+        dpts themselves take the port now, so that a mapping given it cannot
+        fail its whole batch later.
+        """
+        return True
+
+    def register_metrics(self, register):
+        """Register any metrics of our own with Metrics.register."""
+        pass
+
+    def _queue(self, added, i, dip):
+        if self._opened is None:
+            self._opened = time.monotonic()
+        self._ops.append((added, i, dip))
+
+    def add(self, i, dip):
+        """Queue the SNAT and DNAT for a mapping."""
+        self._queue(True, i, dip)
+
+    def delete(self, i, dip):
+        """Queue removal of the SNAT and DNAT for a mapping."""
+        self._queue(False, i, dip)
+
+    def timeout(self):
+        """Return seconds until this batch must be committed, or None."""
+        if self._opened is None:
+            return None
+        elapsed = time.monotonic() - self._opened
+        return max(0.0, self.max_latency - elapsed)
+
+    def due(self):
+        """Return True if the batch is full or has waited long enough."""
+        if self._opened is None:
+            return False
+        return len(self._ops) >= self.max_size or self.timeout() == 0.0
+
+    def take(self):
+        """Return the queued changes, leaving the queue empty."""
+        ops, self._ops = self._ops, []
+        self._opened = None
+        return ops
+
+    def commit(self):
+        """Apply every queued change in one transaction, then reset."""
+        ops = self.take()
+        if ops:
+            self.apply(ops)
+
+    def apply(self, ops):
+        """
+        Atomically apply a list of (added, request, dip) changes.
+
+        Raises MProxyError if the changes could not be applied, in which case
+        none of them may have taken effect.
+        """
+        raise NotImplementedError()
+
+    def _run(self, command, script):
+        log.debug(script)
+        try:
+            status, out, err = run_command(command, script,
+                                           stdout=subprocess.DEVNULL,
+                                           stderr=subprocess.PIPE)
+        except OSError as e:
+            # Failing to fork, or to find the command, changed nothing.
+            raise MProxyError('{} failed: {}'.format(command[0], str(e)))
+        if status != 0:
+            raise MProxyError('{} failed ({}): {}'.format(
+                command[0], status, err.strip()))
+
+
+class IPTablesBackend(NATBackend):
+    """
+    The original backend: a pair of rules per mapping.
+
+    Rules are kept out of the builtin chains. PREROUTING and POSTROUTING jump
+    to MPROXY-PRE and MPROXY-POST, which jump to a pair of chains per client.
+    Packets only walk their own client's rules, and dropping every mapping of
+    one client (or of all of them) is a matter of flushing and deleting
+    chains, however many mappings there are.
+
+    Each iptables invocation re-reads and re-writes the entire nat table, so
+    rather than forking it twice per mapping, a batch is handed to a single
+    `iptables-restore --noflush` call.
+    """
+
+    name = 'iptables'
+
+    def __init__(self, *args, **kwargs):
+        super(IPTablesBackend, self).__init__(*args, **kwargs)
+        # The number of mappings installed for each client with chains.
+        self._clients = {}
+        self._restore = RESTORE_COMMAND
+
+    @staticmethod
+    def _client_chains(cip):
+        n = ip_to_int(cip)
+        return CLIENT_CHAIN.format(PRE_CHAIN, n), \
+            CLIENT_CHAIN.format(POST_CHAIN, n)
+
+    def _saved(self):
+        return run_command(SAVE_COMMAND, stderr=None)[1].splitlines()
+
+    @staticmethod
+    def _chains(saved):
+        """Return our chains in saved, with the client chains first."""
+        chains = [line[1:].split()[0] for line in saved
+                  if line.startswith(':MPROXY-')]
+        return sorted(chains, key=lambda c: c in (PRE_CHAIN, POST_CHAIN))
+
+    def setup(self, warm=False):
+        super(IPTablesBackend, self).setup(warm)
+        try:
+            self._run(RESTORE_COMMAND, RESTORE_PROBE)
+        except MProxyError as e:
+            log.warning('iptables-restore does not take --wait, so commits '
+                        'by workers are not serialized: %s', str(e))
+            self._restore = RESTORE_COMMAND[:-1]
+        saved = self._saved()
+        chains = self._chains(saved)
+        lines = ['*nat']
+        if not warm:
+            lines += self._removal(chains)
+        lines += ['-N ' + chain for chain in (PRE_CHAIN, POST_CHAIN)
+                  if chain not in chains]
+        lines += ['-A ' + jump for jump in CHAIN_JUMPS
+                  if '-A ' + jump not in saved]
+        if len(lines) > 1:
+            self._run(self._restore, '\n'.join(lines + ['COMMIT\n']))
+        if not warm:
+            self._clients = {}
+
+    @staticmethod
+    def _removal(chains):
+        # Flushing our chains first unlinks the client chains, so that they
+        # can be deleted.
+        return ['-F ' + chain for chain in chains] + \
+            ['-X ' + chain for chain in chains
+             if chain not in (PRE_CHAIN, POST_CHAIN)]
+
+    def teardown(self):
+        saved = self._saved()
+        lines = ['-D ' + jump for jump in CHAIN_JUMPS if '-A ' + jump in saved]
+        chains = self._chains(saved)
+        lines += self._removal(chains)
+        lines += ['-X ' + chain for chain in chains
+                  if chain in (PRE_CHAIN, POST_CHAIN)]
+        if lines:
+            self._run(self._restore,
+                      '\n'.join(['*nat'] + lines + ['COMMIT\n']))
+        self._clients = {}
+
+    def purge(self):
+        lines = self._removal(self._chains(self._saved()))
+        if lines:
+            self._run(self._restore,
+                      '\n'.join(['*nat'] + lines + ['COMMIT\n']))
+        self._clients = {}
 
-# Protocol information
-MPROXY_VERSION = 1
-MPROXY_REQUEST = 0
-MPROXY_RESPONSE = 1
-REQUEST_FORMAT = '!BBxx4sHH'
+    def apply(self, ops):
+        counts = {}
+        for added, i, dip in ops:
+            count = counts.get(i.cip, self._clients.get(i.cip, 0))
+            counts[i.cip] = count + 1 if added else count - 1
+        # New clients get their chains before any rules go in. The rules of
+        # clients left with no mappings are not deleted one by one; their
+        # chains are flushed and deleted instead.
+        head = ['*nat']
+        tail = []
+        for cip, count in counts.items():
+            chains = self._client_chains(cip)
+            jumps = [CLIENT_JUMP.format(chain=chain, cip=cip, client_chain=c)
+                     for chain, c in zip((PRE_CHAIN, POST_CHAIN), chains)]
+            if count and not self._clients.get(cip):
+                head += ['-N ' + chain for chain in chains]
+                head += ['-A ' + jump for jump in jumps]
+            elif not count and self._clients.get(cip):
+                tail += ['-F ' + chain for chain in chains]
+                tail += ['-D ' + jump for jump in jumps]
+                tail += ['-X ' + chain for chain in chains]
+        lines = head
+        for added, i, dip in ops:
+            if not counts[i.cip]:
+                continue
+            action = '-A ' if added else '-D '
+            i_dict = i._asdict()
+            i_dict['dip'] = dip
+            i_dict['pre'], i_dict['post'] = self._client_chains(i.cip)
+            lines.append(action + SNAT_RULE.format(**i_dict))
+            lines.append(action + DNAT_RULE.format(**i_dict))
+        lines += tail
+        lines.append('COMMIT\n')
+        self._run(self._restore, '\n'.join(lines))
+        for cip, count in counts.items():
+            if count:
+                self._clients[cip] = count
+            else:
+                self._clients.pop(cip, None)
 
-# IANA suggested
-MIN_EPHEM = 49152
-MAX_EPHEM = 65535
+    def _tagged_rules(self):
+        return [line[3:] for line in self._saved()
+                if line.startswith('-A ') and RULE_TAG in line]
 
-log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-log.addHandler(ch)
+    def installed(self):
+        # iptables-save normalizes rules (adding /32 masks and -m tcp, and
+        # spelling out --to-source), so pick out the options we care about.
+        snat = {}
+        dnat = {}
+        for rule in self._tagged_rules():
+            words = rule.split()
+            opts = {flag: value for flag, value in zip(words, words[1:])
+                    if flag.startswith('-')}
+            try:
+                cip = opts['-s'].split('/')[0]
+                target = opts['-j']
+                if target == 'SNAT':
+                    rip = opts['-d'].split('/')[0]
+                    dip = opts.get('--to-source', opts.get('--to'))
+                    snat[(cip, rip, int(opts['--dport']))] = dip
+                elif target == 'DNAT':
+                    dip = opts['-d'].split('/')[0]
+                    to = opts.get('--to-destination', opts.get('--to'))
+                    rip, rpt = to.rsplit(':', 1)
+                    dnat[(cip, int(opts['--dport']))] = (rip, int(rpt), dip)
+            except (KeyError, AttributeError, ValueError):
+                log.warning('Ignoring unexpected rule: %s', rule)
+        mappings = {}
+        self._clients = {}
+        for (cip, dpt), (rip, rpt, dip) in dnat.items():
+            if snat.get((cip, rip, rpt)) == dip:
+                mappings[Request(rip=rip, rpt=rpt, dpt=dpt, cip=cip)] = dip
+                self._clients[cip] = self._clients.get(cip, 0) + 1
+        return mappings
 
-def ip_for(address):
-    """Return the IP address of the interface that routes us to address."""
 
-    # All we do here is connect a UDP socket -- no packet is sent on it. This
-    # has the effect of asking the OS to consult its routing table to see what
-    # interface will get us to `address`. We can find that address from
-    # getsockname() after the fact. Kinda clever, in my opinion.
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.connect((address, 53))
-    addr = s.getsockname()[0]
-    s.close()
-    return addr
+class NftablesBackend(NATBackend):
+    """
+    Keeps every mapping in a pair of nftables maps within our own table.
 
+    The prerouting chain looks up (cip, dpt) to find the remote to DNAT to,
+    and the postrouting chain looks up (cip, rip, rpt) to find the address to
+    SNAT from. Each is a single rule, so per-packet cost does not grow with the
+    number of mappings, and adding a mapping is just two element inserts.
 
-def is_port_open(n):
+    If offload, established connections through our mappings are offloaded
+    to a flowtable, so that their packets skip the prerouting, NAT and
+    forwarding hooks. It is set up on every interface with an address, and
+    extended to any other device that the addresses we SNAT from, or the
+    addresses of our clients, are routed through. Routes to clients are
+    looked up in routes, a RouteCache, which should be the one the MProxy
+    uses.
     """
-    Return True if there is a TCP server listening on that port.
 
-    This only considers non-loopback servers (i.e. remote address is not
-    127.0.0.1 or ::1).
+    name = 'nft'
+
+    def __init__(self, max_latency=DEFAULT_BATCH_LATENCY,
+                 max_size=DEFAULT_BATCH_SIZE, offload=False, routes=None):
+        super(NftablesBackend, self).__init__(max_latency, max_size)
+        self.offload = offload
+        self._routes = RouteCache() if routes is None else routes
+        # Devices in our flowtable, and the devices found for addresses.
+        self._devices = set()
+        self._interfaces = {}
+
+    def setup(self, warm=False):
+        super(NftablesBackend, self).setup(warm)
+        if warm and run_command(['nft', 'list', 'table', 'ip', NFT_TABLE],
+                                stdout=subprocess.DEVNULL)[0] == 0:
+            self._devices = self._flowtable_devices() if self.offload \
+                else set()
+            if self._devices:
+                return
+            script = ''
+        else:
+            # Adding then deleting the table discards any left over from a
+            # previous run without failing when there is none.
+            script = 'add table ip {t}\ndelete table ip {t}\n'.format(
+                t=NFT_TABLE) + NFT_RULESET
+        devices = set()
+        if self.offload:
+            # Done here, before any workers are forked, so that there is only
+            # ever one offload rule.
+            devices = ipv4_interfaces()
+            if not devices:
+                raise MProxyError('No interfaces to offload connections on')
+            script += NFT_OFFLOAD_SET + NFT_FLOWTABLE.format(
+                devices=', '.join(sorted(devices))) + '\n' + NFT_OFFLOAD_CHAIN
+        if script:
+            self._run(NFT_COMMAND, script)
+        self._devices = devices
+
+    def _flowtable_devices(self):
+        status, out, err = run_command(
+            ['nft', 'list', 'flowtable', 'ip', NFT_TABLE, 'ft'])
+        match = NFT_FLOWTABLE_DEVICES.search(out)
+        if status != 0 or match is None:
+            return set()
+        return {d.strip() for d in match.group(1).split(',')}
+
+    def _interface(self, address):
+        if address not in self._interfaces:
+            self._interfaces[address] = interface_of(address)
+        return self._interfaces[address]
+
+    def _offload_devices(self, ops):
+        # Returns the devices our flowtable lacks for the mappings added by
+        # ops: the one we SNAT from and the one the client is reached by.
+        devices = set()
+        for added, i, dip in ops:
+            if added:
+                devices.add(self._interface(dip))
+                devices.add(self._interface(self._routes.lookup(i.cip)))
+        devices.discard(None)
+        return devices - self._devices
+
+    def teardown(self):
+        self._run(NFT_COMMAND, 'delete table ip {}\n'.format(NFT_TABLE))
+
+    def purge(self):
+        script = 'flush map ip {t} snat_map\nflush map ip {t} dnat_map\n'
+        if self.offload:
+            script += 'flush set ip {t} offload_set\n'
+        self._run(NFT_COMMAND, script.format(t=NFT_TABLE))
+
+    def _elements(self, name, pattern):
+        status, out, err = run_command(NFT_LIST_COMMAND + [name])
+        if status != 0:
+            return []
+        return pattern.findall(out)
+
+    def installed(self):
+        snat = {(cip, rip, int(rpt)): dip for cip, rip, rpt, dip in
+                self._elements('snat_map', NFT_SNAT_ELEMENT)}
+        mappings = {}
+        for cip, dpt, rip, rpt in self._elements('dnat_map', NFT_DNAT_ELEMENT):
+            dip = snat.get((cip, rip, int(rpt)))
+            if dip is not None:
+                i = Request(rip=rip, rpt=int(rpt), dpt=int(dpt), cip=cip)
+                mappings[i] = dip
+        return mappings
+
+    def apply(self, ops):
+        lines = []
+        devices = set()
+        if self.offload:
+            devices = self._offload_devices(ops)
+            if devices:
+                # Redeclaring the flowtable adds the new devices to it, from
+                # Linux 5.8. Older kernels ignore it, which we check below.
+                lines.append(NFT_FLOWTABLE.format(
+                    devices=', '.join(sorted(self._devices | devices))))
+        for added, i, dip in ops:
+            i_dict = i._asdict()
+            i_dict['dip'] = dip
+            if added:
+                lines.append(NFT_SNAT_ADD.format(**i_dict))
+                lines.append(NFT_DNAT_ADD.format(**i_dict))
+            else:
+                lines.append(NFT_SNAT_DELETE.format(**i_dict))
+                lines.append(NFT_DNAT_DELETE.format(**i_dict))
+            if self.offload:
+                offload = NFT_OFFLOAD_ADD if added else NFT_OFFLOAD_DELETE
+                lines.append(offload.format(**i_dict))
+        lines.append('')
+        self._run(NFT_COMMAND, '\n'.join(lines))
+        if devices:
+            self._devices |= devices
+            missing = devices - self._flowtable_devices()
+            if missing:
+                log.warning('Not offloading connections via %s: adding '
+                            'devices to a flowtable needs Linux 5.8',
+                            ', '.join(sorted(missing)))
+
+
+class NoopBackend(NATBackend):
     """
-    connections = psutil.net_connections('tcp')
-    for conn in connections:
-        if conn.laddr[0] == '127.0.0.1' or conn.laddr[0] == '::1':
-            # ignore loopback
-            continue
-        if conn.laddr[1] == n and conn.status == psutil.CONN_LISTEN:
+    Installs nothing, for benchmarking the daemon itself (see mproxy_bench.py).
+
+    It does not touch the kernel at all, so needs no privileges.
+    """
+
+    name = 'noop'
+
+    def setup(self, warm=False):
+        pass
+
+    def purge(self):
+        pass
+
+    def installed(self):
+        return {}
+
+    def apply(self, ops):
+        pass
+
+
+class MemoryBackend(NATBackend):
+    """
+    Keeps mappings in a dict instead of the kernel, for unprivileged runs.
+
+    Changes are checked the way the kernel would check them: adding a mapping
+    twice, or deleting one that is not there, fails the whole batch. Each
+    change can be made to take op_latency seconds, to stand in for a real
+    backend while profiling the request path.
+    """
+
+    name = 'memory'
+
+    def __init__(self, max_latency=DEFAULT_BATCH_LATENCY,
+                 max_size=DEFAULT_BATCH_SIZE, op_latency=0.0):
+        super(MemoryBackend, self).__init__(max_latency, max_size)
+        self.op_latency = op_latency
+        self.mappings = {}
+        self.commits = 0
+        self.adds = 0
+        self.deletes = 0
+
+    def setup(self, warm=False):
+        if not warm:
+            self.mappings = {}
+
+    def teardown(self):
+        log.info('Memory backend: %d commits, %d adds, %d deletes, %d left',
+                 self.commits, self.adds, self.deletes, len(self.mappings))
+        self.mappings = {}
+
+    def purge(self):
+        self.mappings = {}
+
+    def installed(self):
+        return dict(self.mappings)
+
+    def apply(self, ops):
+        if self.op_latency:
+            time.sleep(self.op_latency * len(ops))
+        done = []
+        try:
+            for added, i, dip in ops:
+                if added:
+                    if i in self.mappings:
+                        raise MProxyError('{} is already installed'.format(i))
+                    self.mappings[i] = dip
+                else:
+                    if self.mappings.get(i) != dip:
+                        raise MProxyError('{} via {} is not installed'.format(
+                            i, dip))
+                    del self.mappings[i]
+                done.append((added, i, dip))
+        except MProxyError:
+            for added, i, dip in reversed(done):
+                if added:
+                    del self.mappings[i]
+                else:
+                    self.mappings[i] = dip
+            raise
+        self.commits += 1
+        self.adds += sum(1 for added, i, dip in ops if added)
+        self.deletes += sum(1 for added, i, dip in ops if not added)
+
+
+class _Direction(object):
+    """One direction of a relayed connection: src, through a pipe, to dst."""
+
+    __slots__ = ('src', 'dst', 'r', 'w', 'pending', 'eof', 'shut')
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.r, self.w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        # Bytes in the pipe, whether src has reached its end, and whether we
+        # have passed that on to dst.
+        self.pending = 0
+        self.eof = False
+        self.shut = False
+
+    def move(self):
+        """Splice as much as possible from src to dst without blocking."""
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        while True:
+            if self.pending:
+                try:
+                    self.pending -= os.splice(self.r, self.dst.fileno(),
+                                              self.pending, flags=flags)
+                except BlockingIOError:
+                    return
+            elif self.eof:
+                if not self.shut:
+                    self.shut = True
+                    self.dst.shutdown(socket.SHUT_WR)
+                return
+            else:
+                try:
+                    n = os.splice(self.src.fileno(), self.w, RELAY_CHUNK,
+                                  flags=flags)
+                except BlockingIOError:
+                    return
+                if n == 0:
+                    self.eof = True
+                self.pending += n
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
+
+
+class _Relay(object):
+    """A relayed connection: the client's socket and the one to the remote."""
+
+    __slots__ = ('client', 'remote', 'directions', 'events')
+
+    def __init__(self, client, remote):
+        self.client = client
+        self.remote = remote
+        self.directions = (_Direction(client, remote),
+                           _Direction(remote, client))
+        # fd -> the epoll events each socket is registered for, if any.
+        self.events = {}
+
+    def interest(self, sk):
+        """Return the epoll events to wait for on sk."""
+        events = 0
+        for d in self.directions:
+            # Only read once the pipe has been emptied, so a slow reader
+            # holds back its writer.
+            if d.src is sk and not d.eof and not d.pending:
+                events |= select.EPOLLIN
+            if d.dst is sk and d.pending:
+                events |= select.EPOLLOUT
+        return events
+
+    def done(self):
+        return all(d.shut for d in self.directions)
+
+
+class RelayBackend(NATBackend):
+    """
+    Relays detoured connections in userspace, for hosts without netfilter.
+
+    Instead of installing NAT rules, we listen on each dpt in use and accept
+    the connections clients make to it. The client's address picks its
+    mapping on that dpt, and we connect on to (rip, rpt). Bytes are then moved
+    with splice(2) through a pipe in each direction, so they never enter
+    Python. One thread drives every listener and connection from an epoll
+    loop, so thousands of connections need no more than one core.
+
+    Deleting a mapping stops new connections through it, but like conntrack
+    entries, connections already relayed carry on. Nothing needs privileges
+    unless dpts are below 1024.
+    """
+
+    name = 'relay'
+
+    def __init__(self, max_latency=DEFAULT_BATCH_LATENCY,
+                 max_size=DEFAULT_BATCH_SIZE):
+        super(RelayBackend, self).__init__(max_latency, max_size)
+        # (cip, dpt) -> (mapping, dip), dpt -> listening socket, and dpt ->
+        # socket bound by claim_port() but not yet in use. The lock keeps
+        # changes from racing the relay thread.
+        self.mappings = {}
+        self._listeners = {}
+        self._claimed = {}
+        self._lock = threading.Lock()
+        self._epoll = None
+        # fd -> handler of epoll events on it, and the fds closed since the
+        # last poll began, whose events are stale (the fd may be reused).
+        self._handlers = {}
+        self._closed = set()
+        self._relays = set()
+        self.accepted = 0
+        self.refused = 0
+        self.failed = 0
+
+    def setup(self, warm=False):
+        # Nothing is forwarded by the kernel, and nothing outlives us.
+        if not hasattr(os, 'splice'):
+            raise MProxyError('The relay backend needs os.splice (Python '
+                              '3.10 or later on Linux)')
+
+    def _start(self):
+        # Started by whichever process applies mappings, since workers are
+        # forked after setup(). Every relay needs two sockets and two pipes.
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        self._epoll = select.epoll()
+        threading.Thread(target=self._run, name='relay', daemon=True).start()
+
+    def teardown(self):
+        self.purge()
+        log.info('Relay backend: %d connections accepted, %d refused, %d '
+                 'failed', self.accepted, self.refused, self.failed)
+
+    def purge(self):
+        with self._lock:
+            for relay in list(self._relays):
+                self._close(relay)
+            for listener in self._listeners.values():
+                self._unwatch(listener)
+                self._discard(listener)
+            for sk in self._claimed.values():
+                self._discard(sk)
+            self._listeners = {}
+            self._claimed = {}
+            self.mappings = {}
+
+    def installed(self):
+        with self._lock:
+            return dict(self.mappings.values())
+
+    def owns_port(self, n):
+        return n in self._listeners or n in self._claimed
+
+    def claim_port(self, n):
+        # Listening on 0.0.0.0 fails if someone listens on a single address
+        # (which the ListenIndex leaves out) or if n is privileged and we are
+        # not, so find out now rather than when the batch is applied.
+        with self._lock:
+            if n in self._listeners or n in self._claimed:
+                return True
+            try:
+                self._claimed[n] = self._bind(n)
+            except OSError as e:
+                log.debug('Cannot listen on %d: %s', n, str(e))
+                return False
             return True
-    return False
 
+    def register_metrics(self, register):
+        register('mproxy_relay_connections', 'gauge',
+                 'Connections being relayed.', lambda: len(self._relays))
+        register('mproxy_relay_accepted_total', 'counter',
+                 'Connections accepted for a mapping.',
+                 lambda: self.accepted)
+        register('mproxy_relay_refused_total', 'counter',
+                 'Connections accepted on a dpt without a mapping for the '
+                 'client, and closed.', lambda: self.refused)
+        register('mproxy_relay_failed_total', 'counter',
+                 'Connections to a remote that failed.', lambda: self.failed)
 
-Request = namedtuple('Request', ['rip', 'rpt', 'dpt', 'cip'])
+    def _bind(self, dpt):
+        sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sk.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sk.bind(('0.0.0.0', dpt))
+            sk.listen(RELAY_BACKLOG)
+        except OSError:
+            sk.close()
+            raise
+        sk.setblocking(False)
+        return sk
 
+    def _listen(self, dpt):
+        # Mappings restored or replicated from elsewhere were never claimed.
+        sk = self._claimed.pop(dpt, None)
+        if sk is None:
+            try:
+                sk = self._bind(dpt)
+            except OSError as e:
+                raise MProxyError('Could not listen on {}: {}'.format(dpt, e))
+        self._watch(sk, select.EPOLLIN, lambda events: self._accept(sk, dpt))
+        return sk
 
-class MProxyError(Exception):
-    pass
+    def apply(self, ops):
+        if self._epoll is None:
+            self._start()
+        with self._lock:
+            mappings = dict(self.mappings)
+            for added, i, dip in ops:
+                key = (i.cip, i.dpt)
+                if added:
+                    if key in mappings:
+                        raise MProxyError('{} is already installed'.format(i))
+                    mappings[key] = (i, dip)
+                elif mappings.pop(key, (None,))[0] != i:
+                    raise MProxyError('{} is not installed'.format(i))
+            wanted = {dpt for cip, dpt in mappings}
+            opened = []
+            try:
+                for dpt in wanted.difference(self._listeners):
+                    opened.append((dpt, self._listen(dpt)))
+            except MProxyError:
+                for dpt, sk in opened:
+                    self._unwatch(sk)
+                    self._discard(sk)
+                self._unclaim(ops)
+                raise
+            self._listeners.update(opened)
+            self._unclaim(ops)
+            for dpt in set(self._listeners).difference(wanted):
+                sk = self._listeners.pop(dpt)
+                self._unwatch(sk)
+                self._discard(sk)
+            self.mappings = mappings
+
+    def _unclaim(self, ops):
+        # Ports claimed for mappings that were deleted again, or whose batch
+        # failed, are not going to be listened on.
+        for added, i, dip in ops:
+            sk = self._claimed.pop(i.dpt, None)
+            if sk is not None:
+                self._discard(sk)
+
+    def _watch(self, sk, events, handler):
+        self._epoll.register(sk.fileno(), events)
+        self._handlers[sk.fileno()] = handler
+
+    def _unwatch(self, sk):
+        if self._handlers.pop(sk.fileno(), None) is not None:
+            self._epoll.unregister(sk.fileno())
+
+    def _discard(self, sk):
+        self._closed.add(sk.fileno())
+        sk.close()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._closed = set()
+            events = self._epoll.poll()
+            with self._lock:
+                for fd, event in events:
+                    handler = self._handlers.get(fd)
+                    if handler is not None and fd not in self._closed:
+                        try:
+                            handler(event)
+                        except Exception:
+                            log.exception('Relay failed on fd %d', fd)
+
+    def _accept(self, listener, dpt):
+        while True:
+            try:
+                client, addr = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log.warning('Relay accept on %d failed: %s', dpt, str(e))
+                return
+            mapping = self.mappings.get((addr[0], dpt))
+            if mapping is None:
+                self.refused += 1
+                client.close()
+                continue
+            i = mapping[0]
+            self.accepted += 1
+            client.setblocking(False)
+            remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            remote.setblocking(False)
+            remote.connect_ex((i.rip, i.rpt))
+            self._watch(remote, select.EPOLLOUT,
+                        lambda events, c=client, r=remote, i=i:
+                        self._connected(c, r, i))
+
+    def _connected(self, client, remote, i):
+        self._unwatch(remote)
+        error = remote.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            log.info('Relay from %s via %d to %s:%d failed: %s', i.cip,
+                     i.dpt, i.rip, i.rpt, os.strerror(error))
+            self.failed += 1
+            self._discard(client)
+            self._discard(remote)
+            return
+        relay = _Relay(client, remote)
+        self._relays.add(relay)
+        for sk in (client, remote):
+            self._handlers[sk.fileno()] = \
+                lambda events, relay=relay: self._pump(relay, events)
+        self._pump(relay, 0)
+
+    def _pump(self, relay, events):
+        try:
+            if events & select.EPOLLERR:
+                raise OSError('socket error')
+            for d in relay.directions:
+                d.move()
+        except OSError:
+            # Reset by either end; nothing more can be delivered.
+            self._close(relay)
+            return
+        if relay.done():
+            self._close(relay)
+            return
+        # Level triggered, so a socket with nothing to wait for is left out
+        # of the epoll set; otherwise a hung up socket would keep waking us.
+        for sk in (relay.client, relay.remote):
+            fd = sk.fileno()
+            wanted = relay.interest(sk)
+            current = relay.events.get(fd, 0)
+            if wanted == current:
+                continue
+            if not wanted:
+                self._epoll.unregister(fd)
+                del relay.events[fd]
+            elif not current:
+                self._epoll.register(fd, wanted)
+                relay.events[fd] = wanted
+            else:
+                self._epoll.modify(fd, wanted)
+                relay.events[fd] = wanted
+
+    def _close(self, relay):
+        self._relays.discard(relay)
+        for sk in (relay.client, relay.remote):
+            self._handlers.pop(sk.fileno(), None)
+            if relay.events.pop(sk.fileno(), None) is not None:
+                self._epoll.unregister(sk.fileno())
+            self._discard(sk)
+        for d in relay.directions:
+            d.close()
+
+
+BACKENDS = {b.name: b for b in (IPTablesBackend, NftablesBackend,
+                                NoopBackend, MemoryBackend, RelayBackend)}
+
+
+def shard_of(cip, count):
+    """Return which of count workers serves client address cip."""
+    return ip_to_int(cip) % count
+
+
+def reuseport_sockets(port, count):
+    """
+    Return count UDP sockets bound to port, sharded by client address.
+
+    The kernel delivers each datagram to the socket at index
+    shard_of(source address, count), so one client's requests always reach the
+    same socket. Raises OSError if the sharding program can't be attached.
+    """
+    sockets = []
+    for _ in range(count):
+        sk = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sk.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sk.bind(('0.0.0.0', port))
+        sockets.append(sk)
+    program = struct.pack('=HBBiHBBIHBBI',
+                          BPF_LD_W_ABS, 0, 0, SKF_NET_OFF + 12,
+                          BPF_ALU_MOD_K, 0, 0, count,
+                          BPF_RET_A, 0, 0, 0)
+    filters = ctypes.create_string_buffer(program)
+    fprog = struct.pack('HP', 3, ctypes.addressof(filters))
+    sockets[0].setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+    return sockets
+
+
+def exit_on_sigterm():
+    """Turn SIGTERM into SystemExit, so that we clean up on the way out."""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+
+def block_hook_signals():
+    """
+    Block HOOK_SIGNALS in this thread, and so in the threads it starts.
+
+    They are waited for by a thread of their own, see handle_signals(). Any
+    thread not blocking them may be handed one instead, which then either
+    waits for that thread to run Python code again or, with no handler, kills
+    us. So this must be called before any other thread is started.
+    """
+    signal.pthread_sigmask(signal.SIG_BLOCK, HOOK_SIGNALS)
+
+
+def handle_signals(actions):
+    """
+    Start a thread that waits for blocked signals and handles them.
+
+    actions is a dict of signal number -> callable. Whatever a callable raises
+    is logged.
+    """
+    def run():
+        while True:
+            signum = signal.sigwait(actions)
+            try:
+                actions[signum]()
+            except Exception:
+                log.exception('Failed to handle signal %d', signum)
+    t = threading.Thread(target=run, name='signals', daemon=True)
+    t.start()
 
 
 class MProxy(object):
 
-    def __init__(self, port=45672, ip=None):
-        """Simple class that manages IPTables rules for a NAT proxy."""
+    def __init__(self, port=45672, ip=None, backend=None, routes=None,
+                 listening=None, ports=None, shard=None, lease=0,
+                 checkpoint=None, metrics=None, admission=None,
+                 max_mappings=0, drain=0,
+                 load_interval=DEFAULT_LOAD_INTERVAL, replicator=None,
+                 profiler=None, flows=None, board=None):
+        """
+        Simple class that manages NAT mappings for a proxy.
+
+        A worker started by serve_workers() is given its shard, a tuple of
+        (index, count). It only serves the clients in that shard, and leaves
+        setting up and tearing down the backend to the supervisor.
+
+        If lease is nonzero, mappings are deleted after that many seconds
+        unless renewed, either by the client repeating its request or by
+        connections through the mapping showing up in conntrack, as last read
+        by flows, a FlowIndex.
+
+        With a Checkpoint, every mapping is saved as it is made, and on exit
+        the rules are left installed. The next MProxy started with the same
+        checkpoint reconciles it with the kernel, see restore().
+
+        Request latencies and counts are recorded in metrics, a Metrics.
+
+        Requests from clients whose TokenBuckets in admission are empty, and
+        requests for new mappings from clients with max_mappings already (if
+        nonzero), are refused without touching the kernel.
+
+        If drain is nonzero, serve() reads up to that many queued datagrams at
+        each wakeup and handles them as one batch, see _drain().
+
+        Load queries are answered from samples taken every load_interval
+        seconds. A worker given a LoadBoard answers them with the mappings and
+        request rate of all workers on it.
+
+        With a Replicator, the mappings we make are replicated to our peers,
+        and theirs installed here, see adopt().
+
+        While serving, SIGUSR1 toggles profiler, a Profiler, and SIGUSR2 logs
+        the size of our tables, see dump_stats().
+        """
         self._port = port
-        self._entries_by_dpt = {}
-        self._entries_by_rem = {}
-        self._entries = set()
+        self._shard = shard
+        self._entries = MappingTable()
+        self._routes = RouteCache() if routes is None else routes
+        self._listening = ListenIndex() if listening is None else listening
+        self._ports = PortAllocator() if ports is None else ports
+        self._lease = lease
+        self._leases = {}
+        self._wheel = TimerWheel() if lease else None
+        self._flows = FlowIndex() if flows is None else flows
+        self._checkpoint = checkpoint
+        self._admission = admission
+        self._max_mappings = max_mappings
+        self._drain_budget = drain
+        self.drains = 0
+        self.drained = 0
+        self.duplicates = 0
+        # Mappings replicated from peers, and the node id each originated on.
+        # Deleted mappings stay here until their deletion is committed.
+        self._replicator = replicator
+        self._remote = {}
+        self.conflicts = 0
+        # Rule changes not yet committed to the kernel, in the order they were
+        # made (so they can be undone if the commit fails). Changes are
+        # committed in numbered batches; for each remote whose rules are not
+        # yet committed we remember its batch, and responses are held back
+        # until their batch is committed.
+        self._backend = IPTablesBackend() if backend is None else backend
+        self._uncommitted = []
+        self._batch_seq = 0
+        self._pending_rem = {}
+        self._replies = {}
+        # cip -> {rip << 16 | rpt: (response, mapping)} for mappings whose
+        # rules are in place, filled in as they are first answered.
+        self._echoes = {}
+        self._metrics = Metrics() if metrics is None else metrics
+        self._board = board
+        self._board_mappings = 0
+        self._load = LoadSampler(self._sample_requests, load_interval)
+        self._profiler = Profiler() if profiler is None else profiler
+        self._register_metrics()
+
+    def _register_metrics(self):
+        register = self._metrics.register
+        self._backend.register_metrics(register)
+        register('mproxy_mappings', 'gauge', 'Mappings currently recorded.',
+                 lambda: len(self._entries))
+        register('mproxy_uncommitted_changes', 'gauge',
+                 'Mapping changes waiting to be committed.',
+                 lambda: len(self._backend))
+        register('mproxy_route_cache_hits_total', 'counter',
+                 'Route lookups answered from the cache.',
+                 lambda: self._routes.hits)
+        register('mproxy_route_cache_misses_total', 'counter',
+                 'Route lookups that asked the kernel.',
+                 lambda: self._routes.misses)
+        register('mproxy_route_cache_invalidations_total', 'counter',
+                 'Times the route cache was emptied by rtnetlink.',
+                 lambda: self._routes.invalidations)
+        register('mproxy_listen_refreshes_total', 'counter',
+                 'Rebuilds of the listening port index.',
+                 lambda: self._listening.refreshes)
+        register('mproxy_listen_refresh_seconds_total', 'counter',
+                 'Time spent rebuilding the listening port index.',
+                 lambda: self._listening.refresh_time)
+        register('mproxy_listen_last_refresh_seconds', 'gauge',
+                 'Time the last rebuild of the listening port index took.',
+                 lambda: self._listening.last_refresh_time)
+        for handler in log.handlers:
+            if isinstance(handler, LogQueueHandler):
+                register('mproxy_log_dropped_total', 'counter',
+                         'Log lines dropped because the log queue was full.',
+                         lambda: handler.dropped)
+        if self._lease:
+            register('mproxy_conntrack_refreshes_total', 'counter',
+                     'Reads of conntrack for connections through leased '
+                     'mappings.', lambda: self._flows.refreshes)
+            register('mproxy_conntrack_refresh_seconds_total', 'counter',
+                     'Time spent reading conntrack.',
+                     lambda: self._flows.refresh_time)
+        if self._admission is not None:
+            register('mproxy_admission_buckets', 'gauge',
+                     'Clients with a rate limiting bucket.',
+                     lambda: len(self._admission))
+            register('mproxy_admission_evictions_total', 'counter',
+                     'Buckets evicted to make room for other clients.',
+                     lambda: self._admission.evictions)
+        if self._drain_budget:
+            register('mproxy_drains_total', 'counter',
+                     'Wakeups that drained datagrams from the socket.',
+                     lambda: self.drains)
+            register('mproxy_drained_total', 'counter',
+                     'Datagrams read by draining.', lambda: self.drained)
+            register('mproxy_drain_duplicates_total', 'counter',
+                     'Repeated requests dropped within a drained batch.',
+                     lambda: self.duplicates)
+        if self._replicator is not None:
+            register('mproxy_replicated_mappings', 'gauge',
+                     'Mappings originating on peers.',
+                     lambda: len(self._remote))
+            register('mproxy_replication_sent_total', 'counter',
+                     'Replication datagrams sent to peers.',
+                     lambda: self._replicator.sent)
+            register('mproxy_replication_received_total', 'counter',
+                     'Replication datagrams received from peers.',
+                     lambda: self._replicator.received)
+            register('mproxy_replication_conflicts_total', 'counter',
+                     'Mappings that conflicted with a replicated one.',
+                     lambda: self.conflicts)
+
+    def _record(self, i, dip):
+        self._entries.add(i, dip)
+        self._ports.claim(i.cip, i.dpt)
+        # Replicated mappings are expired by the node they originated on.
+        if self._lease and i not in self._remote:
+            self._leases[i] = time.monotonic() + self._lease
+            self._wheel.schedule(i, self._leases[i])
+        if self._checkpoint is not None:
+            self._checkpoint.add(i, dip)
+
+    def _forget(self, i):
+        self._entries.remove(i)
+        self._ports.release(i.cip, i.dpt)
+        self._leases.pop(i, None)
+        echoes = self._echoes.get(i.cip)
+        if echoes is not None:
+            echoes.pop(ip_to_int(i.rip) << 16 | i.rpt, None)
+            if not echoes:
+                del self._echoes[i.cip]
+        if self._checkpoint is not None:
+            self._checkpoint.remove(i)
 
     def add_rules(self, i):
-        """Add IPTables rule and record a request."""
-        i_dict = i._asdict()
-        i_dict['dip'] = ip_for(i.rip)
-        sc = SNAT_COMMAND.format(**i_dict)
-        dc = DNAT_COMMAND.format(**i_dict)
-        os.system(sc)
-        os.system(dc)
-        log.debug(sc)
-        log.debug(dc)
-        self._entries_by_dpt[(i.cip, i.dpt)] = (i.rip, i.rpt)
-        self._entries_by_rem[(i.cip, i.rip, i.rpt)] = i.dpt
-        self._entries.add(i)
+        """Queue NAT rules and record a request."""
+        start = time.perf_counter()
+        dip = self._routes.lookup(i.rip)
+        self._metrics.observe('route', time.perf_counter() - start)
+        self._backend.add(i, dip)
+        self._record(i, dip)
+        self._uncommitted.append((True, i, dip))
+        self._pending_rem[(i.cip, i.rip, i.rpt)] = self._batch_seq
 
     def del_rules(self, i):
-        """Delete IPTables rule and recorded information."""
-        i_dict = i._asdict()
-        i_dict['dip'] = ip_for(i.rip)
-        sc = SNAT_REMOVE_COMMAND.format(**i_dict)
-        dc = DNAT_REMOVE_COMMAND.format(**i_dict)
-        os.system(sc)
-        os.system(dc)
-        log.debug(sc)
-        log.debug(dc)
-        del self._entries_by_dpt[(i.cip, i.dpt)]
-        del self._entries_by_rem[(i.cip, i.rip, i.rpt)]
-        self._entries.remove(i)
+        """Queue NAT rule removal and delete recorded information."""
+        # Remove exactly the rules we installed, even if routing has changed
+        # since then.
+        dip = self._entries[i]
+        self._backend.delete(i, dip)
+        self._forget(i)
+        self._uncommitted.append((False, i, dip))
+
+    def send_response(self, i, addr, sk):
+        """Send the response for i, or hold it until its rules are committed."""
+        data = self.create_response(i)
+        if self._send(data, addr, [i], sk):
+            # Its rules are in place, so repeats can be answered by _echo().
+            self._echoes.setdefault(i.cip, {})[
+                ip_to_int(i.rip) << 16 | i.rpt] = (data, i)
+
+    def _send(self, data, addr, requests, sk):
+        # Returns True if data was sent now rather than held.
+        # Batches are committed in order, so a response covering several
+        # mappings waits for the last batch any of them is pending in.
+        seq = None
+        for i in requests:
+            pending = self._pending_rem.get((i.cip, i.rip, i.rpt))
+            if pending is not None and (seq is None or pending > seq):
+                seq = pending
+        if seq is None:
+            start = time.perf_counter()
+            sk.sendto(data, addr)
+            self._metrics.observe('send', time.perf_counter() - start)
+            return True
+        # Identical requests waiting on the same rules get one response.
+        self._replies.setdefault(seq, {})[(data, addr)] = None
+        return False
+
+    def take_batch(self):
+        """
+        Detach the rule changes queued so far, to be committed as one batch.
+
+        The batch is applied with apply_batch() and must then be passed to
+        finish_batch(). Batches must be finished in the order they were taken,
+        but requests may keep being handled while one is being applied.
+        """
+        seq = self._batch_seq
+        self._batch_seq += 1
+        uncommitted, self._uncommitted = self._uncommitted, []
+        return seq, self._backend.take(), uncommitted
+
+    def apply_batch(self, batch):
+        """Apply a batch to the kernel. Returns the error, if any."""
+        seq, ops, uncommitted = batch
+        if not ops:
+            return None
+        start = time.perf_counter()
+        try:
+            self._backend.apply(ops)
+        except MProxyError as e:
+            self._metrics.count_error(e)
+            return e
+        except Exception as e:
+            # Whatever else goes wrong must still fail the batch, so that the
+            # responses it holds are answered and later batches go ahead.
+            log.exception('Failed to apply rule changes')
+            error = MProxyError('Failed to apply rule changes: {}'.format(e))
+            self._metrics.count_error(error)
+            return error
+        finally:
+            self._metrics.observe('install', time.perf_counter() - start)
+        return None
+
+    def finish_batch(self, batch, error, sk):
+        """Send the responses held for a batch, or undo it if it failed."""
+        seq, ops, uncommitted = batch
+        replies = self._replies.pop(seq, {})
+        for added, i, dip in uncommitted:
+            key = (i.cip, i.rip, i.rpt)
+            if added and self._pending_rem.get(key) == seq:
+                del self._pending_rem[key]
+        if error is not None:
+            # Nothing in the batch was applied, so put our records back the
+            # way they were. The held responses are dropped; clients will
+            # retry their requests.
+            log.error('Dropping %d rule changes and %d responses: %s',
+                      len(uncommitted), len(replies), str(error))
+            for added, i, dip in reversed(uncommitted):
+                if added and i in self._entries:
+                    self._forget(i)
+                    self._remote.pop(i, None)
+                elif not added:
+                    self._record(i, dip)
+            return
+        if self._replicator is not None:
+            self._replicate(uncommitted)
+        for data, addr in replies:
+            start = time.perf_counter()
+            sk.sendto(data, addr)
+            self._metrics.observe('send', time.perf_counter() - start)
+
+    def _replicate(self, uncommitted):
+        # Our own committed changes go to our peers. The batch's net effect
+        # is what counts, so deletions are sent before additions.
+        node = self._replicator.node
+        added = []
+        deleted = []
+        for was_added, i, dip in uncommitted:
+            if was_added:
+                if i in self._entries and i not in self._remote:
+                    added.append((i, node))
+            elif i not in self._entries:
+                if self._remote.pop(i, None) is None:
+                    deleted.append((i, node))
+        if deleted:
+            self._replicator.send(REPL_DELETE, deleted)
+        if added:
+            self._replicator.send(REPL_ADD, added)
+
+    def _origin(self, i):
+        return self._remote.get(i, self._replicator.node)
+
+    def _holdings(self):
+        return [(i, self._origin(i)) for i in self._entries]
+
+    def adopt(self, i, origin):
+        """
+        Install mapping i, replicated from node origin.
+
+        A mapping of the client's that conflicts with i, using either its
+        remote or its dpt, is replaced only if it originated on a node with a
+        higher id than origin (or on origin itself, which has since changed
+        its mind); otherwise i is ignored. Every node settles such a conflict
+        the same way, so the cluster agrees on the survivor. The client that
+        was answered with the loser must ask again.
+        """
+        if not self._in_shard(i.cip):
+            return
+        dpt = self.preexisting_dpt(i)
+        if dpt == i.dpt:
+            return
+        conflicts = []
+        if dpt is not None:
+            conflicts.append(i._replace(dpt=dpt))
+        rival = self._entries.remote_for(i.cip, i.dpt)
+        if rival is not None:
+            conflicts.append(i._replace(rip=rival[0], rpt=rival[1]))
+        if any(self._origin(c) < origin for c in conflicts):
+            self.conflicts += 1
+            return
+        for c in conflicts:
+            self.conflicts += 1
+            request_log.info('LOST %s to %s:%d via %d (node %d wins)',
+                             c.cip, c.rip, c.rpt, c.dpt, origin)
+            self.del_rules(c)
+        if origin != self._replicator.node:
+            self._remote[i] = origin
+        self.add_rules(i)
+        request_log.info('REPL %s to %s:%d via %d (node %d)',
+                         i.cip, i.rip, i.rpt, i.dpt, origin)
+
+    def abandon(self, i, origin):
+        """Delete mapping i, if we hold it as replicated from node origin."""
+        if i in self._entries and self._remote.get(i) == origin:
+            request_log.info('UNRP %s to %s:%d via %d (node %d)',
+                             i.cip, i.rip, i.rpt, i.dpt, origin)
+            self.del_rules(i)
+
+    def receive_replication(self):
+        """Apply the replication messages waiting from our peers."""
+        replicator = self._replicator
+        for kind, node, records, addr in replicator.receive():
+            if kind == REPL_HELLO:
+                replicator.snapshot(self._holdings(), [addr])
+            elif kind == REPL_DELETE:
+                for i, origin in records:
+                    self.abandon(i, origin)
+            elif kind == REPL_ADD:
+                for i, origin in records:
+                    self.adopt(i, origin)
+            else:
+                # A snapshot is everything node holds: its own mappings
+                # missing from it are gone. Mappings that originated here
+                # are only taken back while we recover from a restart;
+                # afterwards we know better.
+                held = {i for i, origin in records}
+                for i in [i for i, origin in self._remote.items()
+                          if origin == node and i not in held]:
+                    self.abandon(i, node)
+                for i, origin in records:
+                    if origin != replicator.node or replicator.recovering:
+                        self.adopt(i, origin)
+
+    def sync(self):
+        """Send our peers a snapshot of our mappings, if one is due."""
+        if self._replicator is not None and self._replicator.due():
+            self._replicator.snapshot(self._holdings())
+
+    def flush(self, sk):
+        """Commit queued rule changes, then send the responses waiting on them."""
+        batch = self.take_batch()
+        self.finish_batch(batch, self.apply_batch(batch), sk)
+
+    def renew(self, i):
+        """Extend the lease of mapping i, if leases are in use."""
+        if self._lease:
+            # The wheel still holds the old expiry; expire_leases() notices
+            # the renewal when that comes around.
+            self._leases[i] = time.monotonic() + self._lease
+
+    def expire_leases(self):
+        """Queue deletion of mappings whose leases have run out."""
+        if not self._lease:
+            return
+        now = time.monotonic()
+        expired = []
+        for i in self._wheel.advance(now):
+            expiry = self._leases.get(i)
+            if expiry is None:
+                # Deleted since it was scheduled.
+                continue
+            if expiry > now:
+                self._wheel.schedule(i, expiry)
+            else:
+                expired.append(i)
+        if not expired:
+            return
+        flows = self._flows.flows
+        for i in expired:
+            if flows is not None and (i.cip, i.dpt) in flows:
+                self.renew(i)
+                self._wheel.schedule(i, self._leases[i])
+                continue
+            request_log.info('EXPR %s to %s:%d via %d',
+                             i.cip, i.rip, i.rpt, i.dpt)
+            self.del_rules(i)
+
+    def timeout(self):
+        """Return how long we may wait for requests before there is work."""
+        timeout = self._backend.timeout()
+        if self._lease and len(self._wheel):
+            tick = max(0.0, self._wheel.next_time() - time.monotonic())
+            timeout = tick if timeout is None else min(timeout, tick)
+        if self._replicator is not None and self._replicator.sock is not None:
+            sync = self._replicator.timeout()
+            timeout = sync if timeout is None else min(timeout, sync)
+        return timeout
 
     def preexisting_dpt(self, i):
         """Returns any preexisting dpt for the client and remote, or None."""
-        return self._entries_by_rem.get((i.cip, i.rip, i.rpt), None)
+        return self._entries.dpt_for(i.cip, i.rip, i.rpt)
 
     def dpt_used_by_client(self, i):
         """Returns truthy if the client has an entry with that dpt already."""
-        return (i.cip, i.dpt) in self._entries_by_dpt
+        return self._entries.remote_for(i.cip, i.dpt) is not None
 
     def dpt_restricted(self, i):
         """Returns truthy if the dpt is restricted."""
-        return is_port_open(i.dpt)
+        # Port 0 asks us to choose, so it is never usable as is.
+        return i.dpt == 0 or self._restricted(i.dpt)
+
+    def _restricted(self, n):
+        # Someone else's server is listening on port n, or the backend cannot
+        # use it. The relay backend listens on dpts itself, and those may be
+        # shared between clients.
+        if self._listening.is_open(n) and not self._backend.owns_port(n):
+            return True
+        return not self._backend.claim_port(n)
 
     def pick_new_dpt(self, i):
-        """Picks a dpt unused by the client so far."""
-        # choose a new one first, in case dpt = 0, or something
-        i = i._replace(dpt=random.randint(MIN_EPHEM, MAX_EPHEM))
-        while self.dpt_used_by_client(i) and not self.dpt_restricted(i.dpt):
-            i = i._replace(dpt=random.randint(MIN_EPHEM, MAX_EPHEM))
-        return i
+        """Picks an unrestricted dpt unused by the client so far."""
+        return i._replace(dpt=self._ports.choose(i.cip, self._restricted))
 
     def create_request(self, data, addr):
         """Validate fields and create request."""
-        version = data[0]
+        version = data[0] if data else None
         if version != MPROXY_VERSION:
             raise MProxyError(
                 'Request version ({}) does not match expected ({})'.format(
                     version, MPROXY_VERSION
             ))
-        if len(data) != struct.calcsize(REQUEST_FORMAT):
-            raise MProxyError('Data length ({}) does not match expected ({})')
-        fields = struct.unpack(REQUEST_FORMAT, data)
+        if len(data) != REQUEST.size:
+            raise MProxyError('Data length ({}) does not match expected ({})'
+                              .format(len(data), REQUEST.size))
+        fields = REQUEST.unpack_from(data)
         # [0] - version, [1] - op, [2] - rip, [3] - rpt, [4] - dpt
         if fields[1] != MPROXY_REQUEST:
             raise MProxyError(
@@ -172,64 +3225,837 @@ class MProxy(object):
 
     def create_response(self, i):
         """Create bytes response."""
-        return struct.pack(REQUEST_FORMAT, MPROXY_VERSION, MPROXY_RESPONSE,
-                           socket.inet_aton(i.rip), i.rpt, i.dpt)
+        return REQUEST.pack(MPROXY_VERSION, MPROXY_RESPONSE,
+                            socket.inet_aton(i.rip), i.rpt, i.dpt)
 
-    def handle_request(self, data, addr, sk):
-        """Handle an incoming UDP request."""
-        # Parse request
-        i = self.create_request(data, addr)
-        log.debug('Incoming: ' + str(i))
+    def create_error(self, i, code):
+        """Create bytes error response, refusing request i for reason code."""
+        return ERROR.pack(MPROXY_VERSION, MPROXY_ERROR, code,
+                          socket.inet_aton(i.rip), i.rpt, i.dpt)
 
-        req_dpt = i.dpt
+    def create_requests(self, data, addr):
+        """Validate fields and create the requests in a version 2 message."""
+        header_size = V2_HEADER.size
+        record_size = V2_RECORD.size
+        if len(data) < header_size:
+            raise MProxyError('Data length ({}) is shorter than a header'
+                              .format(len(data)))
+        version, op, count = V2_HEADER.unpack_from(data)
+        if op != MPROXY_REQUEST:
+            raise MProxyError(
+                'Message op ({}) is not MPROXY_REQUEST ({})'.format(
+                    op, MPROXY_REQUEST
+            ))
+        if count > MAX_V2_RECORDS:
+            raise MProxyError('Record count ({}) exceeds maximum ({})'.format(
+                count, MAX_V2_RECORDS))
+        if len(data) != header_size + count * record_size:
+            raise MProxyError('Data length ({}) does not match {} records'
+                              .format(len(data), count))
+        requests = []
+        for offset in range(header_size, len(data), record_size):
+            rip, rpt, dpt, _ = V2_RECORD.unpack_from(data, offset)
+            requests.append(Request(rip=socket.inet_ntoa(rip), rpt=rpt,
+                                    dpt=dpt, cip=addr[0]))
+        return requests
+
+    def create_responses(self, results):
+        """Create a version 2 response from a list of (request, error code)."""
+        parts = [V2_HEADER.pack(MPROXY_VERSION_2, MPROXY_RESPONSE,
+                                len(results))]
+        for i, code in results:
+            parts.append(V2_RECORD.pack(socket.inet_aton(i.rip), i.rpt, i.dpt,
+                                        code))
+        return b''.join(parts)
+
+    def _in_shard(self, cip):
+        return self._shard is None or \
+            shard_of(cip, self._shard[1]) == self._shard[0]
+
+    def _check_shard(self, cip):
+        if not self._in_shard(cip):
+            raise MProxyError('Client {} is not in shard {}'.format(
+                cip, self._shard[0]))
+
+    def map_request(self, i):
+        """
+        Find or create the mapping for request i.
+
+        Returns the final mapping and the verb to log it with. Raises
+        MProxyRefused if no mapping can be made.
+        """
         verb = 'ADD '
+        start = time.perf_counter()
+        dpt = self.preexisting_dpt(i)
+        now = time.perf_counter()
+        self._metrics.observe('lookup', now - start)
         # Choose new dpt when necessary
-        if self.preexisting_dpt(i):
+        if dpt:
             # We already have a detour for cip, rip, rpt, use that!
-            i = i._replace(dpt=self.preexisting_dpt(i))
+            i = i._replace(dpt=dpt)
+            self.renew(i)
             log.debug('Used preexisting dpt=%d', i.dpt)
             # NO ADD RULES, it's already there
             verb = 'ECHO'
+        elif self._max_mappings and \
+                self._ports.count(i.cip) >= self._max_mappings:
+            raise TooManyMappings('Client {} already has {} mappings'.format(
+                i.cip, self._max_mappings))
         elif self.dpt_used_by_client(i) or self.dpt_restricted(i):
             # We already have a detour for cip, dpt, so pick new dpt!
-            i = self.pick_new_dpt(i)
+            try:
+                i = self.pick_new_dpt(i)
+            finally:
+                self._metrics.observe('restrict', time.perf_counter() - now)
             log.debug('Chose new dpt=%d', i.dpt)
             self.add_rules(i)
         else:
+            self._metrics.observe('restrict', time.perf_counter() - now)
             self.add_rules(i)
+        return i, verb
+
+    def handle_request(self, data, addr, sk):
+        """
+        Handle an incoming UDP request.
+
+        Returns a list of (mapping, requested dpt, verb), one for each request
+        the datagram carried.
+        """
+        start = time.perf_counter()
+        try:
+            handled = self._echo(data, addr, sk)
+            if handled is None:
+                if data and data[0] == MPROXY_VERSION_2:
+                    handled = self.handle_requests(data, addr, sk)
+                elif len(data) == LOAD.size and data[1] == MPROXY_LOAD_QUERY:
+                    handled = self.answer_load(data, addr, sk)
+                else:
+                    handled = self._handle_request(data, addr, sk)
+        except MProxyError as e:
+            self._metrics.count_error(e)
+            raise
+        finally:
+            self._metrics.requests.observe(time.perf_counter() - start)
+        for i, req_dpt, verb in handled:
+            self._metrics.count_verb(verb.strip())
+        return handled
+
+    def create_load(self):
+        """Create bytes load response, from the latest samples."""
+        load = self._load
+        return LOAD.pack(MPROXY_VERSION, MPROXY_LOAD_RESPONSE,
+                         min(0xFFFF, int(load.cpu * 10)),
+                         min(0xFFFFFFFF, self._mapping_count()),
+                         min(0xFFFFFFFF, int(load.request_rate)),
+                         min(0xFFFFFFFF, int(load.egress / 1000)))
+
+    def _sample_requests(self):
+        # Called by our LoadSampler: returns the requests handled so far, by
+        # us or by every worker on our board.
+        requests = sum(self._metrics.requests.counts)
+        if self._board is None:
+            return requests
+        self._board.publish(self._shard[0], len(self._entries), requests)
+        self._board_mappings, requests = self._board.totals()
+        return requests
+
+    def _mapping_count(self):
+        if self._board is None:
+            return len(self._entries)
+        return self._board_mappings
+
+    def answer_load(self, data, addr, sk):
+        """Answer a load query. It makes no mappings, so returns []."""
+        if data[0] != MPROXY_VERSION:
+            raise MProxyError(
+                'Query version ({}) does not match expected ({})'.format(
+                    data[0], MPROXY_VERSION))
+        self._check_shard(addr[0])
+        if self._admission is not None and not self._admission.admit(addr[0]):
+            return []
+        sk.sendto(self.create_load(), addr)
+        self._metrics.count_verb('LOAD')
+        return []
 
-        # echo final mapping
-        sk.sendto(self.create_response(i), addr)
-        return i, req_dpt, verb
+    def _echo(self, data, addr, sk):
+        # The fast path: a repeated version 1 request for a mapping that is in
+        # place is answered with the response we sent last time. Anything
+        # else, including requests the rate limit would refuse, returns None
+        # and takes the long way round.
+        echoes = self._echoes.get(addr[0])
+        if echoes is None or len(data) != REQUEST.size:
+            return None
+        version, op, rip, rpt, dpt = REQUEST_KEY.unpack_from(data)
+        if version != MPROXY_VERSION or op != MPROXY_REQUEST:
+            return None
+        cached = echoes.get(rip << 16 | rpt)
+        if cached is None or (self._admission is not None and
+                              not self._admission.admit(addr[0])):
+            return None
+        response, i = cached
+        sk.sendto(response, addr)
+        if self._lease:
+            self.renew(i)
+        return [(i, dpt, 'ECHO')]
+
+    def _handle_request(self, data, addr, sk):
+        # Parse request
+        start = time.perf_counter()
+        i = self.create_request(data, addr)
+        self._metrics.observe('parse', time.perf_counter() - start)
+        log.debug('Incoming: %s', i)
+        self._check_shard(i.cip)
+        if self._admission is not None and not self._admission.admit(i.cip):
+            # Refused quietly; a flood shouldn't cost us a log line each.
+            sk.sendto(self.create_error(i, MPROXY_ERR_RATE_LIMITED), addr)
+            self._metrics.count_error(RateLimited())
+            return []
+
+        req_dpt = i.dpt
+        try:
+            i, verb = self.map_request(i)
+        except MProxyRefused as e:
+            sk.sendto(self.create_error(i, e.code), addr)
+            raise
+
+        # echo final mapping, once its rules are in place
+        self.send_response(i, addr, sk)
+        return [(i, req_dpt, verb)]
+
+    def handle_requests(self, data, addr, sk):
+        """Handle a version 2 datagram carrying several requests."""
+        start = time.perf_counter()
+        requests = self.create_requests(data, addr)
+        self._metrics.observe('parse', time.perf_counter() - start)
+        log.debug('Incoming: %d requests from %s', len(requests), addr[0])
+        self._check_shard(addr[0])
+        if self._admission is not None and \
+                not self._admission.admit(addr[0], len(requests)):
+            sk.sendto(self.create_responses(
+                [(i, MPROXY_ERR_RATE_LIMITED) for i in requests]), addr)
+            self._metrics.count_error(RateLimited())
+            return []
+
+        results = []
+        handled = []
+        for i in requests:
+            try:
+                mapped, verb = self.map_request(i)
+            except MProxyRefused as e:
+                request_log.error('Refused %s to %s:%d (%s)',
+                                  i.cip, i.rip, i.rpt, str(e))
+                self._metrics.count_error(e)
+                results.append((i, e.code))
+                continue
+            results.append((mapped, 0))
+            handled.append((mapped, i.dpt, verb))
+
+        # one response for the whole datagram, once all its rules are in place
+        self._send(self.create_responses(results), addr,
+                   [i for i, code in results if code == 0], sk)
+        return handled
+
+    def restore(self):
+        """
+        Reconcile the mappings in our checkpoint with those in the kernel.
+
+        Mappings in both are adopted as they are, so connections through them
+        carry on undisturbed. Checkpointed mappings missing from the kernel
+        (their batch never committed, or someone removed them) are installed
+        again, and mappings only in the kernel (we died before checkpointing
+        their removal) are deleted. Other shards' mappings are left alone.
+        """
+        start = time.monotonic()
+        saved = self._checkpoint.open()
+        installed = {i: dip for i, dip in self._backend.installed().items()
+                     if self._in_shard(i.cip)}
+        adopted = reinstalled = 0
+        for i, dip in saved:
+            if not self._in_shard(i.cip) or \
+                    self.preexisting_dpt(i) is not None or \
+                    self.dpt_used_by_client(i):
+                continue
+            # Trust the kernel over the checkpoint about which dip is in use.
+            dip = installed.pop(i, None)
+            if dip is None:
+                self.add_rules(i)
+                reinstalled += 1
+            else:
+                self._record(i, dip)
+                adopted += 1
+        for i, dip in installed.items():
+            self._backend.delete(i, dip)
+        self.flush(None)
+        # Only now that the kernel matches what we hold may the checkpoint
+        # forget the rest, including any whose reinstalling failed.
+        for i, dip in saved:
+            if i not in self._entries:
+                self._checkpoint.remove(i)
+        log.info('Restored %d mappings from %s in %.3fs: %d adopted, %d '
+                 'reinstalled, %d stale deleted', len(self._entries),
+                 self._checkpoint.path, time.monotonic() - start, adopted,
+                 reinstalled, len(installed))
 
     def clean_up(self):
-        """Delete all rules we have created."""
-        for i in list(self._entries):
-            self.del_rules(i)
+        """Delete all rules we have created, unless checkpointed."""
+        # Nobody is waiting on responses for mappings we are tearing down, and
+        # with a checkpoint the client will simply ask our successor. Peers
+        # keep serving our mappings, so our removing them isn't replicated.
+        self._replies = {}
+        if self._replicator is not None:
+            self._replicator.close()
+        if self._checkpoint is not None:
+            self.flush(None)
+            log.info('Leaving %d mappings installed for restart',
+                     len(self._checkpoint))
+            self._checkpoint.close()
+        elif self._shard is None:
+            # Our rules all live in chains (or a table) of our own, which
+            # tearing down removes in one go.
+            log.info('Dropping %d mappings', len(self._entries))
+            self._backend.take()
+            self._uncommitted = []
+            self._backend.teardown()
+        else:
+            # Other workers share our chains, so just delete our clients'.
+            for i in list(self._entries):
+                self.del_rules(i)
+            self.flush(None)
+        self._log_cache_stats()
 
-    def serve(self):
-        """Bind this server to a port and serve forever."""
-        # ensure that we are configured to forward packets
-        os.system('sysctl -w net.ipv4.ip_forward=1')
+    def start(self):
+        """Prepare the kernel and start background helpers, before serving."""
+        if self._shard is None:
+            self._backend.setup(warm=self._checkpoint is not None)
+        self._routes.start()
+        self._listening.start()
+        self._metrics.start()
+        self._load.start()
+        if self._lease:
+            self._flows.start()
+        if self._checkpoint is not None:
+            self.restore()
+        if self._replicator is not None:
+            self._replicator.start()
+
+    def _log_cache_stats(self):
+        log.info('Route cache: %d hits, %d misses, %d invalidations',
+                 self._routes.hits, self._routes.misses,
+                 self._routes.invalidations)
+        log.info('Listening ports: %d refreshes, %.3fs total, %.3fs last',
+                 self._listening.refreshes, self._listening.refresh_time,
+                 self._listening.last_refresh_time)
+        if self._lease:
+            log.info('Conntrack: %d reads, %.3fs total, %.3fs last',
+                     self._flows.refreshes, self._flows.refresh_time,
+                     self._flows.last_refresh_time)
+
+    def _install_hooks(self):
+        # The hooks run on a thread of their own, so they are answered however
+        # long serve() waits for a datagram.
+        handle_signals({signal.SIGUSR1: self._profiler.toggle,
+                        signal.SIGUSR2: self.dump_stats})
+
+    def dump_stats(self):
+        """
+        Log how big our tables are and how well our caches are doing.
+
+        This only reads, so it may be called from another thread while we
+        serve. Dicts that may change meanwhile are copied before walking them.
+        """
+        entries = self._entries
+        log.info('Mappings: %d in %d slots (%.1fMB), %d from peers, '
+                 '%d changes uncommitted', len(entries), entries.capacity,
+                 entries.nbytes() / 1e6, len(self._remote), len(self._backend))
+        used, most = self._ports.occupancy()
+        log.info('Ports: %d clients using %d ports (%.1fMB of bitmaps), '
+                 'at most %.1f%% of the ephemeral range', len(self._ports),
+                 used, self._ports.nbytes() / 1e6, 100 * most)
+        log.info('Echo cache: %d responses for %d clients',
+                 sum(len(echoes) for echoes in list(self._echoes.values())),
+                 len(self._echoes))
+        if self._lease:
+            log.info('Leases: %d on the timer wheel', len(self._wheel))
+        if self._admission is not None:
+            log.info('Admission: %d buckets, %d evictions',
+                     len(self._admission), self._admission.evictions)
+        self._log_cache_stats()
+        log.info('Memory: %.1fMB resident, %d blocks allocated by Python',
+                 psutil.Process().memory_info().rss / 1e6,
+                 sys.getallocatedblocks())
+
+    def _bind(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.bind(('0.0.0.0', self._port))
-        max_size = 512
-        msg_size = struct.calcsize(REQUEST_FORMAT)
+        return s
+
+    def serve(self, s=None):
+        """Serve forever, on socket s or one bound to our port."""
+        block_hook_signals()
+        self.start()
+        self._install_hooks()
+        if s is None:
+            s = self._bind()
+        # Datagrams are received into one buffer rather than a new bytes
+        # object each.
+        buf = bytearray(MAX_DATAGRAM)
+        view = memoryview(buf)
+        # Replication messages arrive on a socket of their own, so then we
+        # wait on both.
+        sockets = [s]
+        if self._replicator is not None:
+            sockets.append(self._replicator.sock)
+        polling = self._drain_budget or len(sockets) > 1
+        if polling:
+            s.setblocking(False)
         try:
             while True:
-                try:
-                    data, addr = s.recvfrom(max_size)
-                    i, req_dpt, verb = self.handle_request(data, addr, s)
-                    log.info('%s %s to %s:%d via %d (%d proposed)', verb,
-                             i.cip, i.rip, i.rpt, i.dpt, req_dpt)
-                except MProxyError as e:
-                    log.error('Encountered exception (%s) while handling data (%r) from %r.',
-                              str(e), data, addr)
+                # Only block until the open batch or a lease tick is due.
+                if polling:
+                    ready = select.select(sockets, [], [], self.timeout())[0]
+                    if s in ready and self._drain_budget:
+                        self._drain(s, buf, view)
+                    elif s in ready:
+                        self._receive(s, buf, view)
+                    if len(sockets) > 1 and sockets[1] in ready:
+                        self.receive_replication()
+                else:
+                    s.settimeout(self.timeout())
+                    self._receive(s, buf, view)
+                self.expire_leases()
+                self.sync()
+                if self._backend.due():
+                    self.flush(s)
+        finally:
+            # No matter what, we want to delete the NAT rules we created.
+            log.info('Received exception, cleaning up!')
+            self.clean_up()
+
+    def _receive(self, s, buf, view):
+        try:
+            n, addr = s.recvfrom_into(buf)
+        except (socket.timeout, BlockingIOError):
+            return
+        self._handle_logged(view[:n], addr, s)
+
+    def _handle_logged(self, data, addr, sk):
+        start = time.perf_counter()
+        try:
+            handled = self.handle_request(data, addr, sk)
+        except MProxyError as e:
+            request_log.error('Encountered exception (%s) while handling '
+                              'data (%r) from %r.', str(e), bytes(data), addr)
+            return
+        ms = 1000 * (time.perf_counter() - start)
+        for i, req_dpt, verb in handled:
+            request_log.info(REQUEST_LOG, verb, i.cip, i.rip, i.rpt, i.dpt,
+                             req_dpt, ms, extra=REQUEST_LOG_EXTRA)
+
+    def _drain(self, s, buf, view):
+        """
+        Handle the datagrams queued on non-blocking socket s as one batch.
+
+        Up to our budget of datagrams are read. A version 1 request repeated
+        from the same address (a client retransmitting while it waits) is only
+        handled once, since one response answers them all. The rules for the
+        whole batch are then committed in one transaction and every response
+        it was holding is sent. Under load datagrams pile up while we commit,
+        so batches grow by themselves without waiting for --batch-latency.
+        """
+        seen = set()
+        count = 0
+        while count < self._drain_budget:
+            try:
+                n, addr = s.recvfrom_into(buf)
+            except (BlockingIOError, InterruptedError):
+                break
+            count += 1
+            data = view[:n]
+            if n == REQUEST.size:
+                version, op, rip, rpt, dpt = REQUEST_KEY.unpack_from(data)
+                key = (addr, rip << 16 | rpt)
+                if key in seen:
+                    self.duplicates += 1
+                    continue
+                seen.add(key)
+            self._handle_logged(data, addr, s)
+        self.drains += 1
+        self.drained += count
+        if len(self._backend):
+            self.flush(s)
+
+    def serve_async(self, s=None):
+        """Serve forever from an asyncio event loop. See MProxyProtocol."""
+        block_hook_signals()
+        self.start()
+        self._install_hooks()
+        if s is None:
+            s = self._bind()
+        loop = asyncio.new_event_loop()
+        transport, protocol = loop.run_until_complete(
+            loop.create_datagram_endpoint(lambda: MProxyProtocol(self, loop),
+                                          sock=s))
+        try:
+            loop.run_forever()
         finally:
-            # No matter what, we want to delete the IPTables rules we created.
             log.info('Received exception, cleaning up!')
+            loop.run_until_complete(protocol.drain())
+            transport.close()
             self.clean_up()
+            loop.close()
+
+
+class MProxyProtocol(asyncio.DatagramProtocol):
+    """
+    Serves MProxy requests from an asyncio event loop.
+
+    Requests are parsed and decided on the loop, and responses for existing
+    mappings are sent straight away. Committing rule changes, which forks
+    iptables or nft, is handed to an executor so that the loop keeps serving
+    other clients meanwhile. Only one batch is applied at a time; changes made
+    while it runs wait for the next one. Since a mapping is recorded as soon
+    as it is decided, repeats of a request whose rules are still being
+    installed simply wait for that install and share its response.
+    """
+
+    def __init__(self, proxy, loop):
+        self._proxy = proxy
+        self._loop = loop
+        self._transport = None
+        self._timer = None
+        self._committing = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+        replicator = self._proxy._replicator
+        if replicator is not None:
+            self._loop.add_reader(replicator.sock, self._replicate)
+        if self._proxy._lease or replicator is not None:
+            self._loop.call_soon(self._tick)
+
+    def _tick(self):
+        self._proxy.expire_leases()
+        self._proxy.sync()
+        self._schedule()
+        self._loop.call_later(LEASE_TICK, self._tick)
+
+    def _replicate(self):
+        self._proxy.receive_replication()
+        self._schedule()
+
+    def datagram_received(self, data, addr):
+        self._proxy._handle_logged(data, addr, self._transport)
+        self._schedule()
+
+    def _schedule(self):
+        """Commit the open batch now if it is due, or arrange to later."""
+        if self._committing is not None:
+            # _committed() will call us again.
+            return
+        backend = self._proxy._backend
+        if backend.due():
+            self._commit()
+        elif self._timer is None and backend.timeout() is not None:
+            self._timer = self._loop.call_later(backend.timeout(),
+                                                self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._schedule()
+
+    def _commit(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = self._proxy.take_batch()
+        self._committing = self._loop.run_in_executor(
+            None, self._proxy.apply_batch, batch)
+        self._committing.add_done_callback(
+            lambda f: self._committed(batch, f.result()))
+
+    def _committed(self, batch, error):
+        self._committing = None
+        self._proxy.finish_batch(batch, error, self._transport)
+        self._schedule()
+
+    def drain(self):
+        """Return a future done once any batch being applied has finished."""
+        if self._proxy._replicator is not None:
+            self._loop.remove_reader(self._proxy._replicator.sock)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        drained = asyncio.Future(loop=self._loop)
+
+        def check(future=None):
+            # Added after it, this runs once _committed() has finished the
+            # batch, which may have started another.
+            if self._committing is None:
+                drained.set_result(None)
+            else:
+                self._committing.add_done_callback(check)
+        check()
+        return drained
+
+
+def serve_workers(port, count, backend, make_proxy, use_asyncio=False,
+                  warm=False):
+    """
+    Serve with count worker processes, each owning a shard of the clients.
+
+    make_proxy(shard) returns the MProxy for a worker. This process supervises:
+    it sets up the backend, and once any worker exits (or we are told to stop)
+    it stops the rest, purges whatever rules they left behind, and tears the
+    backend down. If warm, the workers checkpoint their mappings, so the rules
+    are instead left in place for the next run.
+    """
+    sockets = reuseport_sockets(port, count)
+    backend.setup(warm)
+    workers = {}
+    try:
+        for index, sk in enumerate(sockets):
+            pid = os.fork()
+            if pid == 0:
+                logging_after_fork()
+                # Only the supervisor reacts to ^C; it will tell us to stop.
+                # Hook signals it passes on stay blocked, and so pending,
+                # until serve() waits for them.
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                code = 0
+                try:
+                    proxy = make_proxy((index, count))
+                    if use_asyncio:
+                        proxy.serve_async(sk)
+                    else:
+                        proxy.serve(sk)
+                except SystemExit:
+                    pass
+                except BaseException:
+                    log.exception('Worker %d failed', index)
+                    code = 1
+                finally:
+                    # os._exit() skips atexit, which would write out the logs.
+                    # Another SIGTERM must not interrupt that: the SystemExit
+                    # would carry us on into the supervisor's code below.
+                    try:
+                        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                        logging.shutdown()
+                    finally:
+                        os._exit(code)
+            workers[pid] = index
+
+        def forward(signum):
+            for pid in list(workers):
+                try:
+                    os.kill(pid, signum)
+                except ProcessLookupError:
+                    pass
+        # Profiling and stats hooks are for the workers, which serve.
+        handle_signals({signum: lambda signum=signum: forward(signum)
+                        for signum in HOOK_SIGNALS})
+        log.info('Started %d workers', count)
+        pid, status = os.wait()
+        log.error('Worker %d exited (status %d), stopping',
+                  workers.pop(pid), status)
+    finally:
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+        for pid in workers:
+            os.waitpid(pid, 0)
+        if not warm:
+            backend.purge()
+            backend.teardown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MProxy NAT detour daemon.')
+    parser.add_argument('--port', type=int, default=45672,
+                        help='UDP port to receive requests on')
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        default=IPTablesBackend.name,
+                        help='how NAT mappings are installed in the kernel')
+    parser.add_argument('--batch-latency', type=float,
+                        default=DEFAULT_BATCH_LATENCY * 1000,
+                        help='longest time (ms) a rule change may be held '
+                        'back to share a transaction with others')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='most mappings committed in one transaction')
+    parser.add_argument('--offload', action='store_true',
+                        help='with the nft backend, offload established '
+                        'detoured connections to a flowtable')
+    parser.add_argument('--memory-latency', type=float, default=0,
+                        help='with the memory backend, time (ms) each '
+                        'mapping change takes to commit')
+    parser.add_argument('--route-ttl', type=float, default=DEFAULT_ROUTE_TTL,
+                        help='seconds to trust a cached route lookup when '
+                        'rtnetlink is unavailable')
+    parser.add_argument('--listen-refresh', type=float,
+                        default=DEFAULT_LISTEN_REFRESH,
+                        help='seconds between rebuilds of the index of '
+                        'listening ports that may not be used as dpt')
+    parser.add_argument('--drain', type=int, default=0, metavar='N',
+                        help='at each wakeup, read up to N queued datagrams '
+                        'and commit their rules together (ignored with '
+                        '--asyncio)')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='serve from an asyncio event loop, installing '
+                        'rules without blocking other requests')
+    parser.add_argument('--lease', type=float, default=0,
+                        help='seconds a mapping lives without being '
+                        'requested again or used (default: forever)')
+    parser.add_argument('--conntrack-refresh', type=float,
+                        default=DEFAULT_CONNTRACK_REFRESH,
+                        help='with --lease, seconds between reads of '
+                        'conntrack for connections that keep mappings alive')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes to serve requests with, '
+                        'each owning the clients whose address modulo N is '
+                        'its index')
+    parser.add_argument('--client-rate', type=float, default=0,
+                        help='requests per second each client may make '
+                        '(default: unlimited)')
+    parser.add_argument('--client-burst', type=float,
+                        help='requests a client may make at once, within its '
+                        'rate (default: one second\'s worth)')
+    parser.add_argument('--client-buckets', type=int,
+                        default=DEFAULT_CLIENT_BUCKETS,
+                        help='most clients to track the rate of; the least '
+                        'recently seen are forgotten first')
+    parser.add_argument('--max-mappings', type=int, default=0,
+                        help='most mappings a client may have at once '
+                        '(default: unlimited)')
+    parser.add_argument('--load-interval', type=float,
+                        default=DEFAULT_LOAD_INTERVAL,
+                        help='seconds between samples of the load reported '
+                        'to clients that ask for it')
+    parser.add_argument('--peer', action='append', default=[],
+                        metavar='HOST[:PORT]',
+                        help='replicate mappings with the daemon on HOST '
+                        '(repeat for each other node of the cluster)')
+    parser.add_argument('--replication-port', type=int,
+                        default=DEFAULT_REPL_PORT,
+                        help='UDP port to exchange mappings with peers on '
+                        '(worker N adds N)')
+    parser.add_argument('--node-id', type=int,
+                        help='id of this node among its peers, lower ids '
+                        'winning conflicts (default: the address peers are '
+                        'reached from)')
+    parser.add_argument('--sync-interval', type=float,
+                        default=DEFAULT_SYNC_INTERVAL,
+                        help='seconds between snapshots of all mappings sent '
+                        'to peers')
+    parser.add_argument('--state', metavar='FILE',
+                        help='checkpoint mappings to FILE (FILE.N for each '
+                        'worker) and leave them installed on exit, so a '
+                        'restart adopts them instead of starting empty')
+    parser.add_argument('--metrics', metavar='ADDRESS',
+                        help='serve Prometheus metrics on host:port, or on a '
+                        'Unix socket if ADDRESS contains a / (worker N adds '
+                        'N to the port, or .N to the path)')
+    parser.add_argument('--profile-dir', default=tempfile.gettempdir(),
+                        help='directory SIGUSR1 writes profiles to (default: '
+                        '%(default)s)')
+    parser.add_argument('--profile-seconds', type=float,
+                        default=DEFAULT_PROFILE_SECONDS,
+                        help='seconds SIGUSR1 profiles for, unless sent '
+                        'again sooner')
+    parser.add_argument('--verbose', action='store_true',
+                        help='log debug messages too')
+    parser.add_argument('--log-format', choices=('text', 'json'),
+                        default='text',
+                        help='write log lines as text, or as JSON objects '
+                        'with a member per field for each request')
+    parser.add_argument('--log-sample', type=int, default=1, metavar='N',
+                        help='log only one in every N lines about requests '
+                        'and mappings')
+    parser.add_argument('--log-queue', type=int, default=DEFAULT_LOG_QUEUE,
+                        metavar='N',
+                        help='most log lines waiting to be written by the '
+                        'logging thread before more are dropped (0 writes '
+                        'them as they are logged)')
+    args = parser.parse_args()
+    if args.log_sample < 1:
+        parser.error('--log-sample must be at least 1')
+    if args.offload and args.backend != NftablesBackend.name:
+        parser.error('--offload needs --backend nft')
+    if args.asyncio and sys.version_info < (3, 5):
+        # Serving from our own socket needs create_datagram_endpoint(sock=).
+        parser.error('--asyncio needs Python 3.5 or later')
+    if args.workers > 1 and args.backend == RelayBackend.name:
+        # Workers would each need to listen on the dpts they share.
+        parser.error('--backend relay serves with a single process')
+    peers = []
+    for peer in args.peer:
+        host, _, port = peer.partition(':')
+        peers.append((host, int(port) if port else DEFAULT_REPL_PORT))
+
+    # Shared by the workers, so must exist before they are forked.
+    board = LoadBoard(args.workers) if args.workers > 1 else None
+
+    def make_backend(routes=None):
+        kwargs = {}
+        if args.backend == MemoryBackend.name:
+            kwargs['op_latency'] = args.memory_latency / 1000
+        elif args.backend == NftablesBackend.name:
+            kwargs['offload'] = args.offload
+            kwargs['routes'] = routes
+        return BACKENDS[args.backend](args.batch_latency / 1000,
+                                      args.batch_size, **kwargs)
+
+    def make_proxy(shard):
+        checkpoint = None
+        if args.state is not None:
+            path = args.state if shard is None else \
+                '{}.{}'.format(args.state, shard[0])
+            checkpoint = Checkpoint(path)
+        admission = None
+        if args.client_rate:
+            admission = TokenBuckets(args.client_rate, args.client_burst,
+                                     args.client_buckets)
+        address = args.metrics
+        if address is not None and shard is not None:
+            if '/' in address:
+                address = '{}.{}'.format(address, shard[0])
+            else:
+                host, port = address.rsplit(':', 1)
+                address = '{}:{}'.format(host, int(port) + shard[0])
+        replicator = None
+        if peers:
+            # Worker N replicates with worker N of each peer, which owns the
+            # same clients.
+            offset = 0 if shard is None else shard[0]
+            replicator = Replicator(
+                [(host, port + offset) for host, port in peers],
+                args.replication_port + offset, args.node_id,
+                args.sync_interval)
+        # The backend shares our route cache, for the routes to clients.
+        routes = RouteCache(args.route_ttl)
+        return MProxy(port=args.port, backend=make_backend(routes),
+                      routes=routes,
+                      listening=ListenIndex(args.listen_refresh),
+                      flows=FlowIndex(args.conntrack_refresh),
+                      shard=shard, lease=args.lease, checkpoint=checkpoint,
+                      metrics=Metrics(address), admission=admission,
+                      max_mappings=args.max_mappings, drain=args.drain,
+                      load_interval=args.load_interval,
+                      replicator=replicator,
+                      profiler=Profiler(args.profile_dir,
+                                        args.profile_seconds),
+                      board=board)
+
+    # Before the logging thread starts, so that it doesn't take them either.
+    block_hook_signals()
+    setup_logging(args.verbose, args.log_format == 'json', args.log_sample,
+                  args.log_queue)
+    exit_on_sigterm()
+    if args.workers > 1:
+        serve_workers(args.port, args.workers, make_backend(), make_proxy,
+                      args.asyncio, args.state is not None)
+    elif args.asyncio:
+        make_proxy(None).serve_async()
+    else:
+        make_proxy(None).serve()
 
 
 if __name__ == '__main__':
-    MProxy().serve()
+    main()
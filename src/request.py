@@ -3,6 +3,11 @@
 Send requests to the mproxy daemon. Must run from client.
 
 usage: mproxy_client.py DAEMON_IP SERVER_IP SERVER_PORT DETOUR_PORT
+           [SERVER_IP SERVER_PORT DETOUR_PORT ...]
+       mproxy_client.py DAEMON_IP load
+
+With more than one request, they are sent together in one version 2 message.
+The second form asks the daemon how loaded it is.
 """
 
 import logging
@@ -13,7 +18,20 @@ import socket
 MPROXY_VERSION = 1
 MPROXY_REQUEST = 0
 MPROXY_RESPONSE = 1
+MPROXY_ERROR = 2
+MPROXY_LOAD_QUERY = 3
+MPROXY_LOAD_RESPONSE = 4
 REQUEST_FORMAT = '!BBxx4sHH'
+ERROR_FORMAT = '!BBH4sHH'
+LOAD_FORMAT = '!BBHIII'
+MPROXY_VERSION_2 = 2
+V2_HEADER_FORMAT = '!BBH'
+V2_RECORD_FORMAT = '!4sHHH'
+MPROXY_ERRORS = {
+    1: 'no free detour ports',
+    2: 'too many requests, slow down',
+    3: 'too many mappings',
+}
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
@@ -21,12 +39,65 @@ ch = logging.StreamHandler()
 ch.setLevel(logging.NOTSET)
 log.addHandler(ch)
 
+def send_v2(s, daemon_ip, requests):
+    """Send several (rip, rpt, dpt) requests in one version 2 datagram."""
+    data = struct.pack(V2_HEADER_FORMAT, MPROXY_VERSION_2, MPROXY_REQUEST,
+                       len(requests))
+    for rip, rpt, dpt in requests:
+        data += struct.pack(V2_RECORD_FORMAT, socket.inet_aton(rip), rpt, dpt,
+                            0)
+    log.debug('Sending %d requests...', len(requests))
+    s.sendto(data, (daemon_ip, 45672))
+    msg, addr = s.recvfrom(len(data))
+    _, op, count = struct.unpack_from(V2_HEADER_FORMAT, msg)
+    offset = struct.calcsize(V2_HEADER_FORMAT)
+    failed = False
+    for _ in range(count):
+        rip, rpt, dpt, code = struct.unpack_from(V2_RECORD_FORMAT, msg, offset)
+        offset += struct.calcsize(V2_RECORD_FORMAT)
+        if code:
+            log.error('Request for %s:%d refused: %s (%d)',
+                      socket.inet_ntoa(rip), rpt,
+                      MPROXY_ERRORS.get(code, 'unknown'), code)
+            failed = True
+        else:
+            log.info('Received response: [%d] -> %s:%d', dpt,
+                     socket.inet_ntoa(rip), rpt)
+    return not failed
+
+
+def query_load(s, daemon_ip):
+    """Ask for the daemon's load. Returns (cpu %, mappings, req/s, kbit/s)."""
+    data = struct.pack(LOAD_FORMAT, MPROXY_VERSION, MPROXY_LOAD_QUERY, 0, 0, 0,
+                       0)
+    s.sendto(data, (daemon_ip, 45672))
+    msg, addr = s.recvfrom(len(data))
+    _, op, cpu, mappings, rate, egress = struct.unpack(LOAD_FORMAT, msg)
+    return cpu / 10, mappings, rate, egress
+
+
 def main():
-    if len(sys.argv) != 5:
-        print('usage: mproxy_client.py DAEMON_IP SERVER_IP SERVER_PORT DETOUR_PORT')
+    args = sys.argv[1:]
+    if len(args) == 2 and args[1] == 'load':
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        log.info('CPU %.1f%%, %d mappings, %d requests/s, %d kbit/s egress',
+                 *query_load(s, args[0]))
+        return
+    if len(args) < 4 or (len(args) - 1) % 3 != 0:
+        print('usage: mproxy_client.py DAEMON_IP SERVER_IP SERVER_PORT '
+              'DETOUR_PORT [SERVER_IP SERVER_PORT DETOUR_PORT ...]')
+        print('       mproxy_client.py DAEMON_IP load')
         sys.exit(1)
-    daemon_ip = sys.argv[1]
-    request = sys.argv[2:]
+    daemon_ip = args[0]
+    if len(args) > 4:
+        # Several requests: send them all at once.
+        requests = [(args[n], int(args[n + 1]), int(args[n + 2]))
+                    for n in range(1, len(args), 3)]
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if not send_v2(s, daemon_ip, requests):
+            sys.exit(1)
+        return
+    request = args[1:]
     request[0] = socket.inet_aton(request[0])
     request[1] = int(request[1])
     request[2] = int(request[2])
@@ -36,6 +107,11 @@ def main():
     log.debug('Sending request...')
     s.sendto(data, (daemon_ip, 45672))
     msg, addr = s.recvfrom(len(data))
+    if msg[1] == MPROXY_ERROR:
+        response = struct.unpack(ERROR_FORMAT, msg)
+        log.error('Request refused: %s (%d)',
+                  MPROXY_ERRORS.get(response[2], 'unknown'), response[2])
+        sys.exit(1)
     response = struct.unpack(REQUEST_FORMAT, msg)
     log.info('Received response: [%d] -> %s:%d', response[4],
              socket.inet_ntoa(response[2]), response[3])